@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import logging
+import traceback
+from multiprocessing import Pool
+from optparse import OptionParser
+from timeit import default_timer
+
+from make_caves import carve_world
+
+logger = logging.getLogger("batch_caves")
+
+# Options a manifest entry may give for its world, passed to carve_world.
+# Worlds are already spread across processes so each is carved by one.
+MANIFEST_OPTIONS = ("tunnel_at_player", "num_random_tunnels", "num_lava_tubes", "num_water_tubes",
+                    "seed", "two_phase", "chunk_cache", "full_relight", "use_mmap", "edit_log_file",
+                    "merge_tunnels", "max_branches", "max_blocks",
+                    "preview_file", "pattern_library", "tunnel_patterns", "pattern_cache",
+                    "pose_views")
+
+def load_manifest(m_file):
+    """Load a JSON manifest listing the worlds to carve. Each entry is
+    either the path of a world or an object with the path under "world"
+    and any of MANIFEST_OPTIONS. Returns a list of (world, options)
+    tuples."""
+
+    with open(m_file) as manifest:
+        entries = json.load(manifest)
+
+    if not isinstance(entries, list):
+        raise ValueError("Manifest %s must contain a list of worlds" % m_file)
+
+    jobs = []
+    for number, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            entry = { "world": entry }
+
+        entry = dict(entry)
+        w_file = entry.pop("world", None)
+        if not w_file:
+            raise ValueError("Manifest entry #%d does not name a world" % (number+1))
+
+        unknown = [ name for name in entry if name not in MANIFEST_OPTIONS ]
+        if unknown:
+            raise ValueError("Manifest entry #%d has unknown options: %s" % (number+1, ", ".join(sorted(unknown))))
+
+        jobs.append((w_file, entry))
+
+    return jobs
+
+def carve_job(args):
+    """Carve one manifest world, catching any failure so the rest of the
+    batch keeps going. Returns a dictionary describing the outcome."""
+
+    index, w_file, options = args
+
+    result = { "index": index, "world": w_file, "options": options }
+    start = default_timer()
+    try:
+        result.update(carve_world(w_file, **options))
+        result["status"] = "ok"
+    except Exception:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    result["seconds"] = default_timer() - start
+
+    return result
+
+def run_batch(jobs, processes=None, report=None):
+    """Carve the (world, options) jobs with a pool of worker processes,
+    calling report with each result as soon as its world is done.
+    Returns the results in manifest order."""
+
+    pool = Pool(processes)
+    results = []
+    try:
+        for result in pool.imap_unordered(carve_job, [ (index, w_file, options) for index, (w_file, options) in enumerate(jobs) ]):
+            results.append(result)
+            if report is not None:
+                report(result, len(results), len(jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+    return sorted(results, key=lambda result: result["index"])
+
+def standalone_main():
+    parser = OptionParser("[options] <manifest_filename>")
+
+    parser.add_option("-j", "--jobs",
+                      type="int",
+                      dest="jobs", default=None,
+                      help="Number of worlds carved at the same time, defaults to the number of CPUs")
+
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="File to write a JSON line per world to as each one finishes")
+
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose", default=False,
+                      help="print the log messages of each world being carved")
+
+    (options, args) = parser.parse_args()
+
+    # Only progress is shown unless asked for more
+    root_logger = logging.getLogger()
+    sh = logging.StreamHandler()
+    root_logger.addHandler(sh)
+    root_logger.setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    if len(args) < 1:
+        parser.error("Must specify a manifest file.")
+
+    try:
+        jobs = load_manifest(args[0])
+    except ValueError as error:
+        parser.error(str(error))
+
+    output = open(options.output, "w") if options.output else None
+
+    def report(result, done, total):
+        if result["status"] == "ok":
+            logger.info("[%d/%d] %s: changed %d blocks in %.2f s (%s)" %
+                        (done, total, result["world"], result["changed_blocks"], result["seconds"],
+                         ", ".join([ "%s %.2f s" % (phase, seconds) for phase, seconds in sorted(result["timings"].items()) ])))
+        else:
+            logger.error("[%d/%d] %s: failed after %.2f s\n%s" % (done, total, result["world"], result["seconds"], result["error"]))
+
+        if output is not None:
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            output.flush()
+
+    logger.info("Carving %d worlds" % len(jobs))
+    try:
+        results = run_batch(jobs, processes=options.jobs, report=report)
+    finally:
+        if output is not None:
+            output.close()
+
+    failed = [ result["world"] for result in results if result["status"] != "ok" ]
+    logger.info("Carved %d of %d worlds" % (len(results) - len(failed), len(results)))
+    if failed:
+        logger.error("Failed worlds: %s" % ", ".join(failed))
+
+    root_logger.removeHandler(sh)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(standalone_main())
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import json
+import logging
+import platform
+from optparse import OptionParser
+from timeit import default_timer
+
+import numpy
+from numpy import zeros, arange, clip, median, random, uint8
+from math import radians
+
+from map_view import MapView, PoseMapView
+from caving import make_cave, find_ground_level, tunnel_pattern, lava_tube, water_tube
+
+logger = logging.getLogger(__name__)
+
+BEDROCK_ID = 7
+STONE_ID = 1
+DIRT_ID = 3
+
+class SyntheticBlock(object):
+    def __init__(self, ID):
+        self.ID = ID
+
+class SyntheticMaterials(object):
+    """Just the parts of pymclevel's materials that the caving code uses"""
+
+    def __init__(self):
+        self.Bedrock = SyntheticBlock(BEDROCK_ID)
+
+        # Air and water let light through, everything else blocks it
+        self.lightAbsorption = zeros(256, dtype=uint8) + 15
+        self.lightAbsorption[0] = 0
+        self.lightAbsorption[[8, 9]] = 3
+        self.lightEmission = zeros(256, dtype=uint8)
+        self.lightEmission[[10, 11]] = 15
+
+class SyntheticBounds(object):
+    def __init__(self, minx, miny, minz, maxx, maxy, maxz):
+        self.minx, self.miny, self.minz = minx, miny, minz
+        self.maxx, self.maxy, self.maxz = maxx, maxy, maxz
+
+class SyntheticChunk(object):
+    def __init__(self, chunk_pos, blocks):
+        self.chunkPosition = chunk_pos
+        self.Blocks = blocks
+        self.Data = zeros(blocks.shape, dtype=uint8)
+        self.SkyLight = zeros(blocks.shape, dtype=uint8)
+        self.BlockLight = zeros(blocks.shape, dtype=uint8)
+        self.dirty = False
+
+    def chunkChanged(self, calcLighting=True):
+        self.dirty = True
+
+class SyntheticWorld(object):
+    """In memory stand in for pymclevel's PocketWorld made of chunks_side
+    by chunks_side chunks of rolling terrain. Everything below the ground
+    is stone with dirt on top and bedrock at the bottom, and some of the
+    stone is hollowed out into air pockets. The same seed always makes
+    the same world."""
+
+    Height = 128
+
+    def __init__(self, chunks_side, seed=0, ground_level=64, hill_height=8, pocket_fraction=0.02):
+        self.chunks_side = chunks_side
+        self.seed = seed
+        self.materials = SyntheticMaterials()
+
+        rand = random.RandomState(seed)
+        size = chunks_side * 16
+
+        # Rolling hills from a few random waves
+        x, z = arange(size).reshape(size, 1), arange(size).reshape(1, size)
+        heights = zeros((size, size))
+        for wave in range(3):
+            x_freq, z_freq = rand.uniform(0.01, 0.08, 2)
+            phase = rand.uniform(0, 2 * numpy.pi)
+            heights += numpy.sin(x * x_freq + phase) * numpy.cos(z * z_freq + phase)
+        self.heights = clip(ground_level + hill_height * heights / 3, 2, self.Height - 1).astype(int)
+
+        y = arange(self.Height).reshape(1, 1, self.Height)
+        blocks = zeros((size, size, self.Height), dtype=uint8)
+        blocks[y < self.heights[:, :, None] - 3] = STONE_ID
+        blocks[(y >= self.heights[:, :, None] - 3) & (y < self.heights[:, :, None])] = DIRT_ID
+        blocks[(rand.random_sample(blocks.shape) < pocket_fraction) & (blocks == STONE_ID)] = 0
+        blocks[:, :, 0] = BEDROCK_ID
+
+        self.chunks = {}
+        for cx in range(chunks_side):
+            for cz in range(chunks_side):
+                self.chunks[cx, cz] = SyntheticChunk((cx, cz), blocks[cx*16:(cx+1)*16, cz*16:(cz+1)*16].copy())
+
+    def copy(self):
+        """Returns a world with its own copy of every chunk"""
+
+        world = SyntheticWorld.__new__(SyntheticWorld)
+        world.__dict__.update(self.__dict__)
+        world.chunks = dict([ (pos, SyntheticChunk(pos, chunk.Blocks.copy())) for pos, chunk in self.chunks.items() ])
+        return world
+
+    @property
+    def allChunks(self):
+        return list(self.chunks.keys())
+
+    def containsChunk(self, cx, cz):
+        return (cx, cz) in self.chunks
+
+    def getChunk(self, cx, cz):
+        return self.chunks[cx, cz]
+
+    def getWorldBounds(self):
+        size = self.chunks_side * 16
+        return SyntheticBounds(0, 0, 0, size, self.Height, size)
+
+    def blockAt(self, x, y, z):
+        if y < 0 or y >= self.Height or not self.containsChunk(x >> 4, z >> 4):
+            return 0
+        return self.chunks[x >> 4, z >> 4].Blocks[x & 0xf, z & 0xf, y]
+
+    def setBlockAt(self, x, y, z, blockID):
+        if y < 0 or y >= self.Height or not self.containsChunk(x >> 4, z >> 4):
+            return
+        chunk = self.chunks[x >> 4, z >> 4]
+        chunk.Blocks[x & 0xf, z & 0xf, y] = blockID
+        chunk.chunkChanged()
+
+    def generateLights(self, dirtyChunks=None):
+        pass
+
+    def saveInPlace(self):
+        pass
+
+# Patterns carved by the make_cave benchmarks
+PATTERNS = { "tunnel_pattern": tunnel_pattern,
+             "lava_tube": lava_tube,
+             "water_tube": water_tube,
+             }
+
+# View classes the view benchmarks are run with
+VIEW_CLASSES = { "MapView": MapView,
+                 "PoseMapView": PoseMapView,
+                 }
+
+def start_points(world, count, rand):
+    """Returns random positions away from the world edges just below
+    the ground"""
+
+    size = world.chunks_side * 16
+    x = rand.randint(8, size - 8, count)
+    z = rand.randint(8, size - 8, count)
+    return [ (x[i], world.heights[x[i], z[i]] - 6, z[i]) for i in range(count) ]
+
+def bench_construct(world, view_class, rand, count=100):
+    points = start_points(world, count, rand)
+    def run():
+        for pos in points:
+            view_class(world, tunnel_pattern.shape, pos)
+    return None, run, count
+
+def bench_rotate_y(world, view_class, rand, count=100):
+    view = view_class(world, tunnel_pattern.shape, start_points(world, 1, rand)[0])
+    def run():
+        for step in range(count):
+            view.rotate_y(radians(90))
+    return None, run, count
+
+def bench_translate_relative(world, view_class, rand, count=100):
+    view = view_class(world, tunnel_pattern.shape, start_points(world, 1, rand)[0])
+    def run():
+        for step in range(count):
+            view.translate_relative((0, 0, 1 - 2 * (step % 2)))
+    return None, run, count
+
+def bench_map_data_read(world, view_class, rand, count=100):
+    views = [ view_class(world, tunnel_pattern.shape, pos) for pos in start_points(world, count, rand) ]
+    def run():
+        for view in views:
+            view.map_data()
+    return None, run, count
+
+def bench_map_data_write(world, view_class, rand, count=100):
+    points = start_points(world, count, rand)
+    def setup():
+        copy = world.copy()
+        views = [ view_class(copy, tunnel_pattern.shape, pos) for pos in points ]
+        return (views,)
+    def run(views):
+        for view in views:
+            view.map_data(zeros(tunnel_pattern.shape, dtype=int))
+    return setup, run, count
+
+def bench_bounds_matrix(world, view_class, rand, count=100):
+    views = [ view_class(world, tunnel_pattern.shape, pos) for pos in start_points(world, count, rand) ]
+    def run():
+        for view in views:
+            view.bounds_matrix()
+    return None, run, count
+
+def bench_find_ground_level(world, view_class, rand, count=20):
+    points = start_points(world, count, rand)
+    def run():
+        for x, y, z in points:
+            find_ground_level(world, (x, z))
+    return None, run, count
+
+def make_cave_bench(pattern, count=5):
+    def bench(world, view_class, rand):
+        points = start_points(world, count, rand)
+        yaws = rand.randint(0, 4, count)
+        cave_seed = rand.randint(0, 2**31 - 1)
+        def setup():
+            # Every repeat carves the same caves into a fresh world
+            random.seed(cave_seed)
+            copy = world.copy()
+            return ([ view_class(copy, pattern.shape, pos, yaw=radians(yaw * 90)) for pos, yaw in zip(points, yaws) ],)
+        def run(views):
+            for view in views:
+                make_cave(view, pattern)
+        return setup, run, count
+    return bench
+
+# Benchmarks as (name, function, whether the view class matters) tuples,
+# each function takes a world, view class and random state and returns
+# an optional setup function, the timed function and how many operations
+# it performs. The setup function's result is passed to the timed one.
+BENCHMARKS = [ ("construct", bench_construct, True),
+               ("rotate_y", bench_rotate_y, True),
+               ("translate_relative", bench_translate_relative, True),
+               ("map_data_read", bench_map_data_read, True),
+               ("map_data_write", bench_map_data_write, True),
+               ("bounds_matrix", bench_bounds_matrix, True),
+               ("find_ground_level", bench_find_ground_level, False),
+               ] + \
+             [ ("make_cave[%s]" % name, make_cave_bench(PATTERNS[name]), True) for name in sorted(PATTERNS) ]
+
+def time_benchmark(setup, run, repeat):
+    """Returns the seconds each of repeat calls of run took"""
+
+    times = []
+    for count in range(repeat):
+        args = setup() if setup is not None else ()
+        start = default_timer()
+        run(*args)
+        times.append(default_timer() - start)
+    return times
+
+def run_benchmarks(sizes, seeds, repeat=5, names=None, view_names=None):
+    """Run the benchmarks whose names contain any of the given names,
+    or all of them, against a synthetic world of each size in chunks
+    and seed. Returns a list of result dictionaries."""
+
+    if view_names is None:
+        view_names = sorted(VIEW_CLASSES)
+
+    results = []
+    for chunks_side in sizes:
+        for seed in seeds:
+            world = SyntheticWorld(chunks_side, seed)
+            for name, bench, uses_view in BENCHMARKS:
+                if names and not [ part for part in names if part in name ]:
+                    continue
+
+                for view_name in (view_names if uses_view else [None]):
+                    # Every benchmark gets the same inputs for a given seed
+                    rand = random.RandomState(seed)
+                    setup, run, count = bench(world, VIEW_CLASSES.get(view_name), rand)
+                    times = time_benchmark(setup, run, repeat)
+
+                    result = { "benchmark": name,
+                               "view": view_name,
+                               "world_chunks": chunks_side,
+                               "seed": seed,
+                               "operations": count,
+                               "repeat": repeat,
+                               "best": min(times),
+                               "median": float(median(times)),
+                               "mean": sum(times) / len(times),
+                               "best_per_operation": min(times) / count,
+                               }
+                    logger.info("%-28s %-12s %3d chunks seed %d: %.6f s per operation" %
+                                (name, view_name or "", chunks_side, seed, result["best_per_operation"]))
+                    results.append(result)
+    return results
+
+def int_list(value):
+    return [ int(part) for part in value.split(",") if part ]
+
+def standalone_main():
+    parser = OptionParser("[options]")
+
+    parser.add_option("-s", "--sizes",
+                      dest="sizes", default="4,8,16",
+                      help="Comma separated sizes of the synthetic worlds in chunks per side")
+
+    parser.add_option("--seeds",
+                      dest="seeds", default="0,1,2",
+                      help="Comma separated seeds used to generate worlds and benchmark inputs")
+
+    parser.add_option("-n", "--repeat",
+                      type="int",
+                      dest="repeat", default=5,
+                      help="Number of times each benchmark is timed")
+
+    parser.add_option("-b", "--benchmark",
+                      action="append", dest="benchmarks", default=None,
+                      help="Only run benchmarks whose name contains this, may be given more than once")
+
+    parser.add_option("--view",
+                      action="append", dest="views", default=None,
+                      help="Only run view benchmarks with this view class, may be given more than once")
+
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="File to write JSON results to instead of standard output")
+
+    parser.add_option("--label",
+                      dest="label", default=None,
+                      help="Label stored with the results, such as the commit benchmarked")
+
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose", default=False,
+                      help="print debugging values")
+
+    (options, args) = parser.parse_args()
+
+    logger = logging.getLogger()
+    sh = logging.StreamHandler()
+    logger.addHandler(sh)
+    if options.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # make_cave logs every step, which would dominate the timings
+    logging.getLogger("caving").setLevel(logging.WARNING)
+
+    if options.views:
+        unknown = [ name for name in options.views if name not in VIEW_CLASSES ]
+        if unknown:
+            parser.error("Unknown view class: %s" % ", ".join(unknown))
+
+    results = run_benchmarks(int_list(options.sizes), int_list(options.seeds),
+                             repeat=options.repeat, names=options.benchmarks, view_names=options.views)
+
+    report = { "label": options.label,
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": numpy.__version__,
+               "platform": platform.platform(),
+               "results": results,
+               }
+
+    if options.output:
+        with open(options.output, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+        logger.info("Wrote %d results to %s" % (len(results), options.output))
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    logger.removeHandler(sh)
+
+if __name__ == "__main__":
+    standalone_main()
@@ -0,0 +1,112 @@
+import logging
+
+from numpy import asarray, ascontiguousarray, zeros, argsort, flatnonzero, diff, concatenate, unique
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Chunks are 16 x 16 columns of blocks in the x and z dimensions
+CHUNK_SHIFT = 4
+CHUNK_MASK = 0xf
+
+def chunk_groups(world, coords):
+    """Split an array of x, y, z block coordinates shaped (..., 3) into
+    groups of blocks sharing the same chunk. Yields the chunk position
+    and for each block in the group its flat index into the coordinates
+    along with its x, z and y indexes inside of the chunk. Blocks outside
+    of the world height or in chunks not present in the world are left
+    out, the same way blockAt and setBlockAt ignore them."""
+
+    coords = asarray(coords).reshape(-1, 3).astype(int)
+    x, y, z = coords[:, 0], coords[:, 1], coords[:, 2]
+
+    valid = flatnonzero((y >= 0) & (y < world.Height))
+    if len(valid) == 0:
+        return
+
+    cx = x[valid] >> CHUNK_SHIFT
+    cz = z[valid] >> CHUNK_SHIFT
+
+    # Sort blocks by chunk so that each chunk is a contiguous run
+    order = argsort(cx * (1 << 24) + cz, kind="mergesort")
+    valid, cx, cz = valid[order], cx[order], cz[order]
+    starts = concatenate(([0], flatnonzero(diff(cx) | diff(cz)) + 1, [len(valid)]))
+
+    for beg, end in zip(starts[:-1], starts[1:]):
+        chunk_pos = (int(cx[beg]), int(cz[beg]))
+        if not world.containsChunk(*chunk_pos):
+            continue
+
+        index = valid[beg:end]
+        yield chunk_pos, index, x[index] & CHUNK_MASK, z[index] & CHUNK_MASK, y[index]
+
+def read_blocks(world, coords, array_name="Blocks"):
+    """Returns the values of a chunk array, Blocks by default, at each
+    of the x, y, z coordinates in an array shaped (..., 3). Each chunk
+    is read with a single indexing operation. Missing blocks read as 0
+    like they do from blockAt."""
+
+    coords = asarray(coords)
+    out_data = zeros(coords.shape[:-1], dtype=int)
+    out_flat = out_data.reshape(-1)
+
+    for chunk_pos, index, cx, cz, cy in chunk_groups(world, coords):
+        chunk = world.getChunk(*chunk_pos)
+        out_flat[index] = getattr(chunk, array_name)[cx, cz, cy]
+        profiling.count("chunks_read")
+
+    profiling.count("blocks_read", out_flat.size)
+
+    return out_data
+
+def write_blocks(world, coords, values, array_name="Blocks", calc_lighting=True):
+    """Set the values of a chunk array, Blocks by default, at each of the
+    x, y, z coordinates in an array shaped (..., 3) from an array shaped
+    like the coordinates without their last dimension. Only chunks that
+    receive a block are marked as changed, calc_lighting tells them if
+    their lighting needs updating. Returns the values that are
+    now in the world, which is 0 for blocks that could not be set, without
+    reading them back."""
+
+    coords = asarray(coords)
+    values = asarray(values)
+
+    if tuple(values.shape) != tuple(coords.shape[:-1]):
+        raise Exception("values must have shape of %s to match coordinates, not: %s" % (coords.shape[:-1], values.shape))
+
+    # World wrappers that track modified chunks themselves, such
+    # as ChunkCache, are told about every chunk written to
+    mark_dirty = getattr(world, "markDirty", None)
+
+    values_flat = values.reshape(-1)
+    out_data = zeros(coords.shape[:-1], dtype=int)
+    out_flat = out_data.reshape(-1)
+
+    for chunk_pos, index, cx, cz, cy in chunk_groups(world, coords):
+        chunk = world.getChunk(*chunk_pos)
+        chunk_array = getattr(chunk, array_name)
+        new_values = values_flat[index].astype(chunk_array.dtype)
+        chunk_array[cx, cz, cy] = new_values
+        chunk.chunkChanged(calc_lighting)
+        if mark_dirty is not None:
+            mark_dirty(*chunk_pos)
+
+        # Report what was stored after conversion to the array type
+        out_flat[index] = new_values
+        profiling.count("chunks_written")
+
+    profiling.count("blocks_written", out_flat.size)
+
+    return out_data
+
+def last_unique(coords):
+    """Returns the indexes of the last occurrence of each distinct x, y, z
+    coordinate in an array shaped (N, 3), so that writing only those
+    blocks gives the same result as writing all of them in order"""
+
+    coords = ascontiguousarray(asarray(coords).reshape(-1, 3))
+
+    # The first occurrence in the reversed coordinates is the last one
+    reversed_keys = coords[::-1].copy().view([("", coords.dtype)] * 3).reshape(-1)
+    return len(coords) - 1 - unique(reversed_keys, return_index=True)[1]
@@ -0,0 +1,166 @@
+import logging
+
+from numpy import asarray, zeros, unique, stack, flatnonzero, bitwise_or, unpackbits, uint8
+
+from block_io import CHUNK_SHIFT, CHUNK_MASK
+
+logger = logging.getLogger(__name__)
+
+class VoxelOccupancy(object):
+    """Sparse set of block positions stored as one bitset per chunk,
+    created the first time a block of the chunk is added. Adding and
+    looking up blocks costs the same regardless of how many are stored."""
+
+    def __init__(self, height=128):
+        self.height = height
+        self.chunk_bytes = 16 * 16 * height // 8
+        self.chunks = {}
+
+    def __len__(self):
+        return int(sum([ unpackbits(bits).sum() for bits in self.chunks.values() ]))
+
+    def chunk_groups(self, coords):
+        """Yields the chunk position of each chunk the x, y, z coordinates
+        in an array shaped (..., 3) fall in, along with the flat index of
+        those coordinates and their byte and bit in the chunk's bitset.
+        Coordinates outside of the world height are left out."""
+
+        coords = asarray(coords).reshape(-1, 3).astype(int)
+        valid = flatnonzero((coords[:, 1] >= 0) & (coords[:, 1] < self.height))
+        x, y, z = coords[valid, 0], coords[valid, 1], coords[valid, 2]
+
+        bit_index = ((x & CHUNK_MASK) * 16 + (z & CHUNK_MASK)) * self.height + y
+        chunk_positions, chunk_index = unique(stack([x >> CHUNK_SHIFT, z >> CHUNK_SHIFT], axis=-1).reshape(-1, 2),
+                                              axis=0, return_inverse=True)
+        chunk_index = chunk_index.reshape(-1)
+
+        for key_index, (cx, cz) in enumerate(chunk_positions):
+            in_chunk = chunk_index == key_index
+            yield (int(cx), int(cz)), valid[in_chunk], bit_index[in_chunk] >> 3, bit_index[in_chunk] & 7
+
+    def add(self, coords):
+        """Add the blocks at the x, y, z coordinates in an array shaped (..., 3)"""
+
+        for chunk_pos, index, byte_index, bit in self.chunk_groups(coords):
+            bits = self.chunks.get(chunk_pos)
+            if bits is None:
+                bits = zeros(self.chunk_bytes, dtype=uint8)
+                self.chunks[chunk_pos] = bits
+            bitwise_or.at(bits, byte_index, (1 << bit).astype(uint8))
+
+    def contains(self, coords):
+        """Returns a boolean array shaped like the coordinates without their
+        last dimension telling which of the blocks have been added"""
+
+        coords = asarray(coords)
+        found = zeros(coords.shape[:-1], dtype=bool)
+        found_flat = found.reshape(-1)
+
+        for chunk_pos, index, byte_index, bit in self.chunk_groups(coords):
+            bits = self.chunks.get(chunk_pos)
+            if bits is not None:
+                found_flat[index] = (bits[byte_index] >> bit) & 1
+
+        return found
+
+    def overlap(self, coords):
+        """Returns the fraction of the blocks at the coordinates that have
+        been added"""
+
+        found = self.contains(coords)
+        if found.size == 0:
+            return 0.0
+        return found.sum() / float(found.size)
+
+class CaveNetwork(object):
+    """Graph of the tunnels carved in a run kept in growable arrays. Nodes
+    are the positions where caves start, branch and end, segments are the
+    stretches of tunnel between two nodes. Every block carved by a
+    finished cave is added to a VoxelOccupancy so that caves can tell when
+    they run into an existing tunnel."""
+
+    segment_dtype = [("start", "<i4"), ("end", "<i4"), ("cave", "<i4"),
+                     ("branch_level", "<i4"), ("steps", "<i4")]
+
+    def __init__(self, height=128, capacity=64):
+        self.occupancy = VoxelOccupancy(height)
+
+        self.nodes = zeros((capacity, 3), dtype=int)
+        self.num_nodes = 0
+
+        self.segments = zeros(capacity, dtype=self.segment_dtype)
+        self.stop_reasons = []
+        self.num_segments = 0
+
+        self.num_caves = 0
+
+    def add_node(self, position):
+        """Add a node at an x, y, z position, returns its index"""
+
+        if self.num_nodes == len(self.nodes):
+            grown = zeros((2 * len(self.nodes), 3), dtype=int)
+            grown[:self.num_nodes] = self.nodes
+            self.nodes = grown
+
+        self.nodes[self.num_nodes] = position
+        self.num_nodes += 1
+        return self.num_nodes - 1
+
+    def new_cave(self):
+        """Returns the index for a new cave"""
+
+        self.num_caves += 1
+        return self.num_caves - 1
+
+    def start_segment(self, start_node, cave, branch_level=0):
+        """Start a segment of a cave at a node, returns its index. The
+        segment stays open until end_segment is called."""
+
+        if self.num_segments == len(self.segments):
+            grown = zeros(2 * len(self.segments), dtype=self.segment_dtype)
+            grown[:self.num_segments] = self.segments
+            self.segments = grown
+
+        segment = self.segments[self.num_segments]
+        segment["start"] = start_node
+        segment["end"] = -1
+        segment["cave"] = cave
+        segment["branch_level"] = branch_level
+        segment["steps"] = 0
+        self.stop_reasons.append(None)
+
+        self.num_segments += 1
+        return self.num_segments - 1
+
+    def add_step(self, segment):
+        self.segments[segment]["steps"] += 1
+
+    def end_segment(self, segment, end_node, stop_reason=None):
+        """Close a segment at a node, with the reason its cave stopped when
+        the cave ends there instead of continuing or branching"""
+
+        self.segments[segment]["end"] = end_node
+        self.stop_reasons[segment] = stop_reason
+
+    def node_segments(self, node):
+        """Returns the indexes of the segments starting or ending at a node"""
+
+        segments = self.segments[:self.num_segments]
+        return flatnonzero((segments["start"] == node) | (segments["end"] == node))
+
+    def summary(self):
+        """Returns a dictionary describing the network"""
+
+        segments = self.segments[:self.num_segments]
+        stops = {}
+        for reason in self.stop_reasons:
+            if reason is not None:
+                stops[reason] = stops.get(reason, 0) + 1
+
+        return { "caves": self.num_caves,
+                 "nodes": self.num_nodes,
+                 "segments": self.num_segments,
+                 "steps": int(segments["steps"].sum()),
+                 "occupied_chunks": len(self.occupancy.chunks),
+                 "stops": stops,
+                 }
@@ -0,0 +1,276 @@
+import logging
+
+from math import radians
+from numpy import array, zeros, concatenate, tile, uint8
+
+from block_io import read_blocks, write_blocks, last_unique
+from caving import choose_step, random_start, ROTATE, BRANCH, STOP_BOUNDS, STOP_AIR, STOP_BEDROCK, STOP_MAX_LENGTH
+from edit_log import EditLog
+from ground_index import GroundLevelIndex
+from map_view import PoseMapView
+from patterns import compile_pattern
+from rng import make_rng
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Kinds of blocks a BlockMask distinguishes
+MASK_AIR = 0
+MASK_SOLID = 1
+MASK_BEDROCK = 2
+
+class BlockMask(object):
+    """Array of every block in a world reduced to whether it is air,
+    bedrock or some other solid block, indexed by x, y and z relative
+    to the world bounds. Lets caves be planned without reading the world."""
+
+    def __init__(self, world):
+        bb = world.getWorldBounds()
+        self.lower = array((bb.minx, bb.miny, bb.minz))
+        self.upper = array((bb.maxx, bb.maxy, bb.maxz))
+        self.bedrock_id = world.materials.Bedrock.ID
+
+        # Blocks in missing chunks read as air
+        self.mask = zeros(self.upper - self.lower, dtype=uint8)
+
+        for cx, cz in world.allChunks:
+            x_beg = cx * 16 - self.lower[0]
+            z_beg = cz * 16 - self.lower[2]
+            if x_beg < 0 or z_beg < 0 or x_beg >= self.mask.shape[0] or z_beg >= self.mask.shape[2]:
+                continue
+
+            # Chunk blocks are indexed by x, z and y
+            blocks = world.getChunk(cx, cz).Blocks[:, :, bb.miny:bb.maxy].swapaxes(1, 2)
+            x_size, z_size = self.mask[x_beg:x_beg+16, 0, z_beg:z_beg+16].shape
+            self.mask[x_beg:x_beg+16, :, z_beg:z_beg+16] = self.categorize(blocks[:x_size, :, :z_size])
+
+    def categorize(self, block_ids):
+        """Returns the mask values for an array of block IDs"""
+
+        categories = zeros(block_ids.shape, dtype=uint8)
+        categories[block_ids != 0] = MASK_SOLID
+        categories[block_ids == self.bedrock_id] = MASK_BEDROCK
+        return categories
+
+    def in_bounds(self, coords):
+        """Returns true if all x, y, z coordinates in an array shaped
+        (..., 3) are within the world bounds"""
+
+        coords = coords.reshape(-1, 3)
+        return (coords.min(axis=0) >= self.lower).all() and (coords.max(axis=0) < self.upper).all()
+
+    def lookup(self, coords):
+        """Returns the mask values at the x, y, z coordinates in an array
+        shaped (..., 3), all of which must be within the world bounds"""
+
+        index = coords - self.lower
+        return self.mask[index[..., 0], index[..., 1], index[..., 2]]
+
+    def stamp(self, coords, block_ids):
+        """Update the mask for blocks set to the given IDs at the x, y, z
+        coordinates in an array shaped (..., 3)"""
+
+        index = coords - self.lower
+        self.mask[index[..., 0], index[..., 1], index[..., 2]] = self.categorize(block_ids)
+
+class CavePlan(object):
+    """Skeleton of a cave made by plan_cave. Records the center position
+    and rotation of the view at every step where the pattern gets
+    stamped, the branches launched along the way and why the cave
+    stopped."""
+
+    def __init__(self, shape, branch_level=0):
+        self.shape = tuple(shape)
+        self.branch_level = branch_level
+
+        self.centers = []
+        self.rotations = []
+
+        # Branches as (step index, CavePlan) tuples, each launched
+        # right after the pattern is stamped at that step
+        self.branches = []
+
+        self.length = 0
+        self.stop_reason = STOP_MAX_LENGTH
+
+    def steps(self):
+        """Returns the (center, rotation) of every step of the cave and its
+        branches in the order they would be carved"""
+
+        branches = {}
+        for step_index, branch in self.branches:
+            branches.setdefault(step_index, []).append(branch)
+
+        steps = []
+        for step_index, step in enumerate(zip(self.centers, self.rotations)):
+            steps.append(step)
+            for branch in branches.get(step_index, []):
+                steps += branch.steps()
+        return steps
+
+    def num_branches(self):
+        """Returns the number of branches in the whole branch tree"""
+
+        return sum([ 1 + branch.num_branches() for step_index, branch in self.branches ])
+
+def plan_cave(view, pattern, mask,
+              max_cave_len=250,
+              rotate_dir_prob=0.5, # Probability to prefer 90 over -90 deg
+              do_rotate_prob=0.5, turns_till_rotate=10,
+              shear_range=(-1, 1), vert_inc_prob=0.4,
+              branch_prob=0.3, turns_till_branch=20, branch_level=0, rng=None):
+    """Plan the path make_cave would carve starting from a PoseMapView,
+    checking when to stop against a BlockMask instead of the world. The
+    mask is updated with the planned pattern so later steps and caves
+    see it. Draws the same random numbers as make_cave so a given random
+    state plans the cave make_cave would carve. Returns a CavePlan."""
+
+    rng = make_rng(rng)
+
+    plan = CavePlan(view.shape, branch_level)
+
+    # Only the points we will actually set within the pattern get stamped
+    pattern = compile_pattern(pattern)
+
+    forward_inc = pattern.shape[0]
+
+    cave_len = 0
+    turns_since_rotate = 0
+    turns_since_branch = 0
+    while cave_len < max_cave_len:
+
+        coords = view.view[..., :3]
+        if not mask.in_bounds(coords):
+            plan.stop_reason = STOP_BOUNDS
+            break
+
+        categories = mask.lookup(coords)
+        if (categories == MASK_AIR).all():
+            plan.stop_reason = STOP_AIR
+            break
+        elif (categories == MASK_BEDROCK).any():
+            plan.stop_reason = STOP_BEDROCK
+            break
+
+        mask.stamp(view.pattern_coords(pattern), pattern.values)
+        plan.centers.append(view.center.copy())
+        plan.rotations.append(view.rotation.copy())
+
+        action, turn_dir, shear_inc, y_inc = choose_step(turns_since_rotate, turns_since_branch,
+                                                         rotate_dir_prob=rotate_dir_prob,
+                                                         do_rotate_prob=do_rotate_prob,
+                                                         turns_till_rotate=turns_till_rotate,
+                                                         shear_range=shear_range,
+                                                         vert_inc_prob=vert_inc_prob,
+                                                         branch_prob=branch_prob,
+                                                         turns_till_branch=turns_till_branch,
+                                                         rng=rng)
+
+        if action == ROTATE:
+            view.rotate_y(radians(turn_dir))
+            turns_since_rotate = 0
+
+        elif action == BRANCH:
+            branch_view = view.clone()
+            branch_view.rotate_y(radians(turn_dir))
+
+            branch = plan_cave(branch_view, pattern, mask,
+                               max_cave_len=max_cave_len/2, # Not the main tunnel so make it shorter
+                               rotate_dir_prob=rotate_dir_prob,
+                               do_rotate_prob=do_rotate_prob,
+                               turns_till_rotate=turns_till_rotate,
+                               shear_range=shear_range,
+                               vert_inc_prob=vert_inc_prob,
+                               branch_prob=0, # Set likelihood of a new branch from this one to 0.0
+                               turns_till_branch=turns_till_branch,
+                               branch_level=branch_level+1,
+                               rng=rng)
+            plan.branches.append((len(plan.centers) - 1, branch))
+            turns_since_branch = 0
+        else:
+            view.translate_relative((shear_inc, y_inc, forward_inc))
+            cave_len += forward_inc
+
+            turns_since_rotate += 1
+            turns_since_branch += 1
+
+    plan.length = cave_len
+    logger.debug("Planned cave %d blocks long with %d branches, stopped by %s", cave_len, len(plan.branches), plan.stop_reason)
+
+    profiling.count("planned_caves")
+    profiling.count("planned_steps", len(plan.centers))
+    profiling.count("planned_branches", len(plan.branches))
+    profiling.count("plan_stops." + plan.stop_reason)
+
+    return plan
+
+def plan_coords(pattern, plan):
+    """Returns the x, y, z coordinates of every block the pattern sets
+    along a CavePlan and its branches as an array shaped (N, 3) in the
+    order they would be carved"""
+
+    compiled = compile_pattern(pattern)
+    steps = plan.steps()
+    if not steps:
+        return zeros((0, 3), dtype=int)
+    return concatenate([ center + compiled.offsets(rotation) for center, rotation in steps ])
+
+def plan_random_caves(world, patterns, mask=None, ground_index=None, rng=None, **kwargs):
+    """Plan a cave for each pattern starting from a random location. All
+    caves are planned against the same mask so later caves see earlier
+    ones, and start points come from a GroundLevelIndex, created when
+    none is given, kept up to date with the blocks of each planned cave
+    so that they start where they would after carving the earlier ones.
+    Random numbers come from rng, a seed or generator, or numpy's global
+    random state by default. Remaining keyword arguments are passed to
+    plan_cave. Returns a list of (pattern, CavePlan) tuples."""
+
+    if mask is None:
+        mask = BlockMask(world)
+    if ground_index is None:
+        ground_index = GroundLevelIndex(world)
+
+    rng = make_rng(rng)
+
+    plans = []
+    for pattern in patterns:
+        start_pos, start_yaw = random_start(world, ground_index, rng=rng)
+        cave_view = PoseMapView(world, pattern.shape, start_pos, yaw=start_yaw)
+        plan = plan_cave(cave_view, pattern, mask, rng=rng, **kwargs)
+        plans.append((pattern, plan))
+
+        coords = plan_coords(pattern, plan)
+        ground_index.update(coords, mask.lookup(coords) != MASK_AIR)
+
+    return plans
+
+def apply_plans(world, plans, edit_log=None):
+    """Stamp the pattern of each (pattern, CavePlan) tuple along its path
+    with a single batched write to the world. Blocks carved more than once
+    end up with the value the last step gave them, as if the caves had
+    been carved one step at a time. Returns an edit log of the changes."""
+
+    if edit_log is None:
+        edit_log = EditLog()
+
+    all_coords = []
+    all_values = []
+    for pattern, plan in plans:
+        all_coords.append(plan_coords(pattern, plan))
+        all_values.append(tile(compile_pattern(pattern).values, len(plan.steps())))
+
+    if not all_coords:
+        return edit_log
+
+    coords = concatenate(all_coords)
+    values = concatenate(all_values)
+
+    last_writes = last_unique(coords)
+    coords = coords[last_writes]
+    values = values[last_writes]
+
+    old_data = read_blocks(world, coords)
+    new_data = write_blocks(world, coords, values)
+    edit_log.record(coords, old_data, new_data)
+
+    return edit_log
@@ -1,8 +1,14 @@
 import logging
-from numpy import array, where, mod, random, ravel
+from collections import deque
+from threading import RLock
+from numpy import array, where, mod, concatenate
 from math import degrees, radians
 
+from block_io import write_blocks
 from map_view import MapView
+from patterns import compile_pattern
+from rng import make_rng
+import profiling
 
 # Define a pattern in the x * y or z * y dimension which will
 # replace existing blocks where caving is in progress. A value
@@ -46,99 +52,420 @@ water_tube = array([
 
 logger = logging.getLogger(__name__)
 
+# Ways a cave can continue after each step
+ROTATE = "rotate"
+BRANCH = "branch"
+FORWARD = "forward"
+
+# Reasons a cave stops
+STOP_BOUNDS = "bounds"
+STOP_AIR = "air"
+STOP_BEDROCK = "bedrock"
+STOP_MAX_LENGTH = "max_length"
+STOP_MERGED = "merged"
+STOP_BUDGET = "budget"
+
+# Orders the tunnels of a cave can be carved in
+DEPTH_FIRST = "depth"
+BREADTH_FIRST = "breadth"
+
+def choose_step(turns_since_rotate, turns_since_branch,
+                rotate_dir_prob=0.5, do_rotate_prob=0.5, turns_till_rotate=10,
+                shear_range=(-1, 1), vert_inc_prob=0.4,
+                branch_prob=0.3, turns_till_branch=20, rng=None):
+    """Randomly decide how a cave continues after a step given how many
+    steps were taken since it last rotated and branched. Returns a tuple
+    of the action, one of ROTATE, BRANCH or FORWARD, the direction in
+    degrees used for rotating or branching and the side to side and
+    vertical amounts to move when going forward. Random numbers come
+    from rng, a seed or anything make_rng accepts."""
+
+    rng = make_rng(rng)
+
+    # For use by branching or turning
+    if (rng.sample() > (1-rotate_dir_prob)):
+        turn_dir =  90
+    else:
+        turn_dir = -90
+
+    # Change orientation every so often
+    if(rng.sample() > (1-do_rotate_prob) and turns_since_rotate > turns_till_rotate):
+        return ROTATE, turn_dir, 0, 0
+
+    elif rng.sample() > (1-branch_prob) and turns_since_branch > turns_till_branch:
+        return BRANCH, turn_dir, 0, 0
+
+    # Random amount of side to side and vertical motion, equally likely
+    shear_inc = rng.random_integers(*shear_range)
+
+    # Random vertical motion
+    # Pick among -1, 0, or 1
+    y_inc = rng.binomial(2, vert_inc_prob)-1 
+
+    return FORWARD, turn_dir, shear_inc, y_inc
+
+class CaveSegment(object):
+    """One tunnel of a cave, either its main tunnel or a branch, with
+    everything needed to pick up carving it where it was left off"""
+
+    def __init__(self, view, max_cave_len, branch_prob, branch_level=0, rng=None, network_node=None, network_cave=None):
+        self.view = view
+        self.max_cave_len = max_cave_len
+        self.branch_prob = branch_prob
+        self.branch_level = branch_level
+        self.rng = make_rng(rng)
+
+        # Where the segment joins the CaveNetwork of the run
+        self.network_node = network_node
+        self.network_cave = network_cave
+        self.network_segment = None
+        self.carved = []
+
+        self.cave_len = 0
+        self.turns_since_rotate = 0
+        self.turns_since_branch = 0
+        self.started = False
+        self.stop_reason = None
+
+class CaveScheduler(object):
+    """Carves the main tunnel and branches of caves from a work queue of
+    CaveSegments instead of recursing into every branch. Depth first
+    order carves each branch as soon as it is launched before going on
+    with the tunnel it came from, exactly like recursing did, so it
+    carves the same caves for a given random state. Breadth first order
+    finishes a tunnel before carving the branches it launched, which get
+    their own random state, and hands every wave of branches to the map
+    method of pool when one is given, such as a ThreadPool. Branches in
+    the same wave that cross each other are then carved in no particular
+    order. With a pool the world is locked for every step, unless the
+    views are on an EditSession, which lets steps in different chunks
+    run at the same time. The number of branches and of blocks carved can be limited,
+    a segment stops once carving another step would go over the limit."""
+
+    def __init__(self, pattern,
+                 rotate_dir_prob=0.5, # Probability to prefer 90 over -90 deg
+                 do_rotate_prob=0.5, turns_till_rotate=10,
+                 shear_range=(-1, 1), vert_inc_prob=0.4,
+                 turns_till_branch=20,
+                 edit_log=None,
+                 network=None, # CaveNetwork of the run to stop at existing tunnels
+                 merge_overlap=0.5, # Fraction of a step already carved to stop at
+                 max_branches=None, max_blocks=None,
+                 order=DEPTH_FIRST, pool=None):
+
+        # Only the points we will actually set within the pattern get written
+        self.pattern = compile_pattern(pattern)
+
+        # How many blocks we move is based on how big the pattern
+        # is in the z direction
+        self.forward_inc = self.pattern.shape[0]
+
+        self.rotate_dir_prob = rotate_dir_prob
+        self.do_rotate_prob = do_rotate_prob
+        self.turns_till_rotate = turns_till_rotate
+        self.shear_range = shear_range
+        self.vert_inc_prob = vert_inc_prob
+        self.turns_till_branch = turns_till_branch
+
+        self.edit_log = edit_log
+        self.network = network
+        self.merge_overlap = merge_overlap
+
+        if order not in (DEPTH_FIRST, BREADTH_FIRST):
+            raise ValueError("Unknown cave order: %s" % order)
+        self.order = order
+        self.pool = pool
+
+        self.max_branches = max_branches
+        self.max_blocks = max_blocks
+        self.num_branches = 0
+        self.num_blocks = 0
+
+        # Segments carved by a pool share the bookkeeping, and the world
+        # unless it is an EditSession locking just the chunks being carved
+        self.lock = RLock()
+
+        # Blocks carved by the finished segments of each cave and how many
+        # of its segments are still open, the cave's blocks only go into
+        # the network's occupancy once all of them are done so that a
+        # cave never runs into its own branches
+        self.cave_carved = {}
+        self.open_segments = {}
+
+        self.queue = deque()
+
+    def carve(self, view, max_cave_len=250, branch_prob=0.3, branch_level=0, rng=None):
+        """Carve a cave starting from a view along with all of its branches.
+        Returns the CaveSegment of its main tunnel."""
+
+        root = CaveSegment(view, max_cave_len, branch_prob, branch_level, rng)
+        self.queue.append(root)
+
+        if self.order == DEPTH_FIRST:
+            # The segment at the end of the queue is always the one
+            # being carved, it only goes on once its branch is done
+            while self.queue:
+                segment = self.queue[-1]
+                branch = self.advance(segment)
+                if branch is None:
+                    self.queue.pop()
+                    self.finish(segment)
+                else:
+                    self.queue.append(branch)
+        else:
+            while self.queue:
+                wave = list(self.queue)
+                self.queue.clear()
+                if self.pool is not None:
+                    launched = self.pool.map(self.carve_segment, wave)
+                else:
+                    launched = [ self.carve_segment(segment) for segment in wave ]
+                for branches in launched:
+                    self.queue.extend(branches)
+
+        return root
+
+    def carve_segment(self, segment):
+        """Carve a segment to its end, returns the branches it launched"""
+
+        branches = []
+        branch = self.advance(segment)
+        while branch is not None:
+            branches.append(branch)
+            branch = self.advance(segment)
+        self.finish(segment)
+        return branches
+
+    def step_lock(self, view):
+        """Returns the lock to hold while a step reads and writes the
+        world, the locks of the chunks around the view when the view is
+        on an EditSession and otherwise the scheduler's own lock"""
+
+        locked = getattr(view.world, "locked", None)
+        if locked is None:
+            return self.lock
+        return locked(view.view[..., :3])
+
+    def start(self, segment):
+        profiling.count("caves")
+
+        # Record the cave in the CaveNetwork shared by the caves of a run,
+        # branches continue the cave of the node they start from
+        if self.network is not None:
+            with self.lock:
+                if segment.network_node is None:
+                    segment.network_node = self.network.add_node(segment.view.center_position())
+                    segment.network_cave = self.network.new_cave()
+                    self.open_segments[segment.network_cave] = 1
+                segment.network_segment = self.network.start_segment(segment.network_node, segment.network_cave,
+                                                                     segment.branch_level)
+        segment.started = True
+
+    def advance(self, segment):
+        """Carve a segment until it launches a branch, which is returned, or
+        until it stops, when None is returned"""
+
+        if not segment.started:
+            self.start(segment)
+
+        view = segment.view
+        pattern = self.pattern
+        network = self.network
+        edit_log = self.edit_log
+
+        while segment.cave_len < segment.max_cave_len:
+
+            # Stop without reading the world when the blocks the pattern
+            # sets were mostly carved already by another cave
+            set_coords = view.pattern_coords(pattern)
+            if network is not None and network.occupancy.overlap(set_coords) > self.merge_overlap:
+                logger.info("Ran into an existing tunnel, quiting")
+                segment.stop_reason = STOP_MERGED
+                return None
+
+            with self.step_lock(view):
+                # The step's blocks are counted as soon as they fit in the
+                # budget so that steps carved at the same time can not
+                # both fit and go over it together
+                with self.lock:
+                    over_budget = self.max_blocks is not None and self.num_blocks + len(pattern) > self.max_blocks
+                    if not over_budget:
+                        self.num_blocks += len(pattern)
+                if over_budget:
+                    logger.info("Reached limit of %d carved blocks, quiting" % self.max_blocks)
+                    segment.stop_reason = STOP_BUDGET
+                    return None
+
+                # Read the view's blocks once for every check
+                in_bounds, all_air, hit_bedrock, curr_data = view.check_step()
+                if not in_bounds or all_air or hit_bedrock:
+                    with self.lock:
+                        self.num_blocks -= len(pattern)
+
+                if not in_bounds:
+                    logger.info("Cave went out of bounds, quiting.")
+                    segment.stop_reason = STOP_BOUNDS
+                    return None
+                elif all_air:
+                    logger.info("Hit air pocket, quiting")
+                    logger.debug("%s", curr_data)
+                    segment.stop_reason = STOP_AIR
+                    return None
+                elif hit_bedrock:
+                    # Lets not go past any bedrock blocks or else we might
+                    # make a hole in the world
+                    logger.info("Hit bedrock, quiting")
+                    logger.debug("%s", curr_data)
+                    segment.stop_reason = STOP_BEDROCK
+                    return None
+
+                # Apply pattern to just the blocks it sets, what they held
+                # before is already known from the checks
+                if edit_log is not None:
+                    prev_values = curr_data[pattern.where_set]
+                curr_values = write_blocks(view.world, set_coords, pattern.values)
+
+                # Recorded while the chunks are still locked so that the
+                # edit log keeps the order blocks were written in
+                with self.lock:
+                    if edit_log is not None:
+                        edit_log.record(set_coords, prev_values, curr_values)
+                    profiling.count("cave_steps")
+                    if network is not None:
+                        network.add_step(segment.network_segment)
+                        segment.carved.append(set_coords)
+
+                    # Once the branch limit is reached segments go on as if
+                    # they could not branch, drawing the same random numbers
+                    branch_prob = segment.branch_prob
+                    if self.max_branches is not None and self.num_branches >= self.max_branches:
+                        branch_prob = 0
+
+            # Building these messages costs more than the step itself
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("B: %d P: %s @ %f deg", segment.branch_level,
+                             view.origin_position(),
+                             mod(degrees(view.yaw), 360))
+                logger.debug("%s", curr_values)
+
+            action, turn_dir, shear_inc, y_inc = choose_step(segment.turns_since_rotate, segment.turns_since_branch,
+                                                             rotate_dir_prob=self.rotate_dir_prob,
+                                                             do_rotate_prob=self.do_rotate_prob,
+                                                             turns_till_rotate=self.turns_till_rotate,
+                                                             shear_range=self.shear_range,
+                                                             vert_inc_prob=self.vert_inc_prob,
+                                                             branch_prob=branch_prob,
+                                                             turns_till_branch=self.turns_till_branch,
+                                                             rng=segment.rng)
+
+            # Change orientation every so often
+            if action == ROTATE:
+                logger.info("Changing orientation by %f deg at cave length %d" % (turn_dir, segment.cave_len))
+                view.rotate_y(radians(turn_dir))
+                segment.turns_since_rotate = 0
+
+            elif action == BRANCH:
+                logger.info("Launching branch by %f deg at cave length %d" % (turn_dir, segment.cave_len))
+                profiling.count("cave_branches")
+                branch_view = view.clone()
+                branch_view.rotate_y(radians(turn_dir))
+                segment.turns_since_branch = 0
+
+                with self.lock:
+                    self.num_branches += 1
+
+                    # The branch point splits this cave's segment in two
+                    branch_node = None
+                    if network is not None:
+                        branch_node = network.add_node(view.center_position())
+                        network.end_segment(segment.network_segment, branch_node)
+                        segment.network_segment = network.start_segment(branch_node, segment.network_cave,
+                                                                        segment.branch_level)
+                        self.open_segments[segment.network_cave] += 1
+
+                # Branches carved later get their own random state so
+                # they do not depend on what is carved in between
+                branch_rng = segment.rng
+                if self.order != DEPTH_FIRST:
+                    branch_rng = segment.rng.spawn_seed()
+
+                return CaveSegment(branch_view,
+                                   segment.max_cave_len/2, # Not the main tunnel so make it shorter
+                                   0, # Set likelihood of a new branch from this one to 0.0
+                                   segment.branch_level+1,
+                                   branch_rng,
+                                   network_node=branch_node,
+                                   network_cave=segment.network_cave)
+            else:
+                # Go forward relative to the current orientation,
+                # Move forward the size of the number of patterns in the z axis
+                view.translate_relative((shear_inc, y_inc, self.forward_inc))
+                segment.cave_len += self.forward_inc
+
+                segment.turns_since_rotate += 1
+                segment.turns_since_branch += 1
+
+        segment.stop_reason = STOP_MAX_LENGTH
+        return None
+
+    def finish(self, segment):
+        """Wrap up a segment that stopped"""
+
+        profiling.count("cave_stops." + segment.stop_reason)
+
+        # Other caves only see this one once it and all of its branches
+        # are done, so that it does not run into the blocks it carved itself
+        if self.network is not None:
+            with self.lock:
+                cave = segment.network_cave
+                self.network.end_segment(segment.network_segment,
+                                         self.network.add_node(segment.view.center_position()),
+                                         segment.stop_reason)
+                self.cave_carved.setdefault(cave, []).extend(segment.carved)
+                self.open_segments[cave] -= 1
+                if self.open_segments[cave] == 0:
+                    del self.open_segments[cave]
+                    carved = self.cave_carved.pop(cave)
+                    if carved:
+                        self.network.occupancy.add(concatenate(carved))
+
+        # Mark that we hit the cave
+        if segment.cave_len > segment.max_cave_len:
+            logger.info("Quit at max cave length %d" % segment.max_cave_len)
+
+        logger.info("Cave was %d blocks long" % (segment.cave_len))
+
 def make_cave(view, pattern, 
               max_cave_len=250, 
               rotate_dir_prob=0.5, # Probability to prefer 90 over -90 deg
               do_rotate_prob=0.5, turns_till_rotate=10,
               shear_range=(-1, 1), vert_inc_prob=0.4,
-              branch_prob=0.3, turns_till_branch=20, branch_level=0):
-
-    # Mark which points we will actually set within the pattern
-    where_set = where(pattern > -1)
-
-    # How many blocks we move is based on how big the pattern
-    # is in the z direction
-    forward_inc = pattern.shape[0]
-    
-    cave_len = 0
-    turns_since_rotate = 0
-    turns_since_branch = 0
-    keep_caving = True
-    while cave_len < max_cave_len:
-    
-        if not view.in_bounds():
-            logger.info("Cave went out of bounds, quiting.")
-            break
-        elif all(ravel(view.map_data()) == 0):
-            logger.info("Hit air pocket, quiting")
-            logger.debug("%s" % view.map_data())
-            break
-        elif any(ravel(view.map_data()) == view.world.materials.Bedrock.ID):
-            # Lets not go past any bedrock blocks or else we might
-            # make a hole in the world
-            logger.info("Hit bedrock, quiting")
-            logger.debug("%s" % view.map_data())
-            break
-
-        # Get current map slice and apply pattern
-        curr_slice = view.map_data()
-        curr_slice[where_set] = pattern[where_set]
-        curr_slice = view.map_data(curr_slice)
-        logger.debug("B: %d P: %s @ %f deg" % (branch_level,
-                                               view.origin_position(), 
-                                               mod(degrees(view.yaw), 360)))
-        logger.debug("%s" % curr_slice)
-
-        # For use by branching or turning
-        if (random.sample() > (1-rotate_dir_prob)):
-            turn_dir =  90
-        else:
-            turn_dir = -90
-
-        # Change orientation every so often
-        if(random.sample() > (1-do_rotate_prob) and turns_since_rotate > turns_till_rotate):
-            logger.info("Changing orientation by %f deg at cave length %d" % (turn_dir, cave_len))
-            view.rotate_y(radians(turn_dir))
-            turns_since_rotate = 0
-
-        elif random.sample() > (1-branch_prob) and turns_since_branch > turns_till_branch:
-            logger.info("Launching branch by %f deg at cave length %d" % (turn_dir, cave_len))
-            branch_view = view.clone()
-            branch_view.rotate_y(radians(turn_dir))
-    
-            # Recurse to make branch cave. 
-            make_cave(branch_view, pattern, 
-                      max_cave_len=max_cave_len/2, # Not the main tunnel so make it shorter
-                      rotate_dir_prob=rotate_dir_prob,
-                      do_rotate_prob=do_rotate_prob, 
-                      turns_till_rotate=turns_till_rotate,
-                      shear_range=shear_range, 
-                      vert_inc_prob=vert_inc_prob,
-                      branch_prob=0, # Set likelihood of a new branch from this one to 0.0
-                      turns_till_branch=turns_till_branch, 
-                      branch_level=branch_level+1)
-            turns_since_branch = 0
-        else:
-            # Random amount of side to side and vertical motion, equally likely
-            shear_inc = random.random_integers(*shear_range)
-
-            # Random vertical motion
-            # Pick among -1, 0, or 1
-            y_inc = random.binomial(2, vert_inc_prob)-1 
-
-            # Go forward relative to the current orientation,
-            # Move forward the size of the number of patterns in the z axis
-            view.translate_relative((shear_inc, y_inc, forward_inc))
-            cave_len += forward_inc
+              branch_prob=0.3, turns_till_branch=20, branch_level=0,
+              edit_log=None, rng=None,
+              network=None, # CaveNetwork of the run to stop at existing tunnels
+              merge_overlap=0.5, # Fraction of a step already carved to stop at
+              max_branches=None, max_blocks=None, # Limits for the cave and its branches
+              order=DEPTH_FIRST, pool=None):
 
-            turns_since_rotate += 1
-            turns_since_branch += 1
-    
-    # Mark that we hit the cave
-    if cave_len > max_cave_len:
-        logger.info("Quit at max cave length %d" % max_cave_len)
-
-    logger.info("Cave was %d blocks long" % (cave_len))
+    # Every random draw of the cave and its branches comes from rng,
+    # numpy's global random state unless a seed or generator is given.
+    # Branches are carved by a CaveScheduler rather than by recursing.
+    scheduler = CaveScheduler(pattern,
+                              rotate_dir_prob=rotate_dir_prob,
+                              do_rotate_prob=do_rotate_prob,
+                              turns_till_rotate=turns_till_rotate,
+                              shear_range=shear_range,
+                              vert_inc_prob=vert_inc_prob,
+                              turns_till_branch=turns_till_branch,
+                              edit_log=edit_log,
+                              network=network,
+                              merge_overlap=merge_overlap,
+                              max_branches=max_branches,
+                              max_blocks=max_blocks,
+                              order=order,
+                              pool=pool)
+    return scheduler.carve(view, max_cave_len=max_cave_len, branch_prob=branch_prob,
+                           branch_level=branch_level, rng=rng)
 
 def find_ground_level(world, pos, percent_ground=0.65, search_size=3):
     """Returns a location in the y axis where the percentage of non
@@ -154,7 +481,7 @@ def find_ground_level(world, pos, percent_ground=0.65, search_size=3):
     # Make posistion for view such that the specified position will be in
     # the middle. View extends from bottom to top of world
     pos = array((pos[0], bb.miny, pos[1]))
-    pos += array((-round(search_size/2), 0, -round(search_size/2)))
+    pos += array((-(search_size // 2), 0, -(search_size // 2)))
 
     # Create a view around the search location
     search_view = MapView(world, (search_size, bb.maxy, search_size), pos)
@@ -169,3 +496,23 @@ def find_ground_level(world, pos, percent_ground=0.65, search_size=3):
         ground_idx += 1
 
     return search_view.view[0, ground_idx, 0][1]
+
+def random_start(world, ground_index=None, rng=None):
+    """Returns a random position at ground level within the world
+    along with a random yaw in radians that is a multiple of 90 deg.
+    Ground level comes from a GroundLevelIndex when one is given."""
+
+    rng = make_rng(rng)
+
+    bb = world.getWorldBounds()
+    x_start = rng.randint(bb.minx, bb.maxx)
+    z_start = rng.randint(bb.minz, bb.maxz)
+    if ground_index is not None:
+        y_start = ground_index.ground_level(x_start, z_start)
+    else:
+        y_start = find_ground_level(world, (x_start, z_start))
+
+    start_pos = (x_start, y_start, z_start)
+    start_yaw = radians(rng.randint(0, 4) * 90)
+
+    return start_pos, start_yaw
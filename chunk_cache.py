@@ -0,0 +1,166 @@
+import logging
+
+from collections import OrderedDict
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Arrays of block data a loaded chunk keeps in memory
+CHUNK_ARRAYS = ("Blocks", "Data", "SkyLight", "BlockLight")
+
+class ChunkCache(object):
+    """Sits between a world object such as pymclevel's PocketWorld and
+    the code editing it to limit how many chunks stay loaded. Chunks
+    are kept in least recently used order and the oldest unmodified
+    chunks are released once their memory use goes over a budget.
+    Modified chunks are tracked explicitly and stay loaded until saved,
+    so lighting and saving only need to visit the chunks that changed.
+    Pinned chunks also stay loaded, for writers that hold on to a chunk
+    before marking it modified. Any attribute not handled here is
+    passed through to the world."""
+
+    def __init__(self, world, max_bytes=64 * 1024 * 1024):
+        self.world = world
+        self.max_bytes = max_bytes
+
+        self.chunks = OrderedDict()
+        self.chunk_bytes = {}
+        self.dirty = set()
+        self.pinned = {}
+
+        # Unmodified chunks in least recently used order, the ones that
+        # may be released, and the memory used by every cached chunk
+        self.clean = OrderedDict()
+        self.used_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the cache itself
+        return getattr(self.world, name)
+
+    def getChunk(self, cx, cz):
+        """Returns the chunk at the given chunk position, loading it
+        from the world if it is not already cached"""
+
+        key = (cx, cz)
+        chunk = self.chunks.pop(key, None)
+        if chunk is not None:
+            self.hits += 1
+            self.chunks[key] = chunk
+            if self.clean.pop(key, None) is not None:
+                self.clean[key] = True
+            return chunk
+
+        self.misses += 1
+        chunk = self.world.getChunk(cx, cz)
+        self.chunks[key] = chunk
+        self.chunk_bytes[key] = sum([ getattr(chunk, name).nbytes for name in CHUNK_ARRAYS if hasattr(chunk, name) ])
+        self.used_bytes += self.chunk_bytes[key]
+        if key not in self.dirty:
+            self.clean[key] = True
+        self.evict()
+
+        return chunk
+
+    def markDirty(self, cx, cz):
+        """Record that the chunk at the given chunk position was modified"""
+
+        self.dirty.add((cx, cz))
+        self.clean.pop((cx, cz), None)
+
+    def pin(self, cx, cz):
+        """Keep the chunk at the given chunk position loaded until it is
+        unpinned as many times as it was pinned"""
+
+        self.pinned[cx, cz] = self.pinned.get((cx, cz), 0) + 1
+
+    def unpin(self, cx, cz):
+        count = self.pinned.pop((cx, cz)) - 1
+        if count:
+            self.pinned[cx, cz] = count
+
+    def blockAt(self, x, y, z):
+        profiling.count("blockAt")
+        if y < 0 or y >= self.world.Height or not self.world.containsChunk(x >> 4, z >> 4):
+            return 0
+        return self.getChunk(x >> 4, z >> 4).Blocks[x & 0xf, z & 0xf, y]
+
+    def setBlockAt(self, x, y, z, blockID):
+        profiling.count("setBlockAt")
+        if y < 0 or y >= self.world.Height or not self.world.containsChunk(x >> 4, z >> 4):
+            return
+        chunk = self.getChunk(x >> 4, z >> 4)
+        chunk.Blocks[x & 0xf, z & 0xf, y] = blockID
+        chunk.chunkChanged()
+        self.markDirty(x >> 4, z >> 4)
+
+    def cached_bytes(self):
+        """Returns the estimated memory used by cached chunks"""
+
+        return self.used_bytes
+
+    def evict(self):
+        """Release the least recently used unmodified chunks until the
+        cache fits in its memory budget. Modified and pinned chunks are
+        never released, so the cache may stay over budget until saved."""
+
+        if self.used_bytes <= self.max_bytes:
+            return
+
+        # The most recently used chunk is the one just handed out,
+        # keep it so its caller can still modify it. Only unmodified
+        # chunks are visited, pinned ones go back to be tried later.
+        newest = next(reversed(self.chunks))
+        kept = []
+        while self.used_bytes > self.max_bytes and self.clean:
+            key = self.clean.popitem(last=False)[0]
+            if key == newest or key in self.pinned:
+                kept.append(key)
+                continue
+
+            del self.chunks[key]
+            self.used_bytes -= self.chunk_bytes.pop(key)
+            self.evictions += 1
+
+            # pymclevel keeps its own reference to every chunk it loads,
+            # drop it as well so the memory is actually released
+            loaded = getattr(self.world, "_loadedChunks", None)
+            if loaded is not None:
+                loaded.pop(key, None)
+
+        for key in kept:
+            self.clean[key] = True
+
+        if self.used_bytes > self.max_bytes:
+            logger.debug("Chunk cache holds %d modified chunks over its budget of %d bytes" % (len(self.dirty), self.max_bytes))
+
+    def generateLights(self, dirtyChunks=None):
+        """Generate lights for the cx, cz chunk positions in dirtyChunks,
+        by default only for the modified chunks"""
+
+        if dirtyChunks is None:
+            dirtyChunks = sorted(self.dirty)
+        return self.world.generateLights(dirtyChunks)
+
+    def saveInPlace(self):
+        """Save the modified chunks, afterwards they can be evicted"""
+
+        self.world.saveInPlace()
+        self.dirty.clear()
+        self.clean = OrderedDict([ (key, True) for key in self.chunks ])
+        self.evict()
+
+    def stats(self):
+        """Returns a dictionary of cache counters"""
+
+        return { "hits": self.hits,
+                 "misses": self.misses,
+                 "evictions": self.evictions,
+                 "cached_chunks": len(self.chunks),
+                 "dirty_chunks": len(self.dirty),
+                 "cached_bytes": self.cached_bytes(),
+                 }
@@ -0,0 +1,144 @@
+import struct
+import logging
+
+from numpy import array, asarray, ascontiguousarray, concatenate, dtype, frombuffer, unique, zeros
+
+from block_io import write_blocks, last_unique
+
+logger = logging.getLogger(__name__)
+
+class EditLog(object):
+    """Collects the blocks changed in a world as records of the block
+    position along with the block ID before and after the change. A log
+    can be saved to a compact binary file and later replayed onto, or
+    rolled back from, another copy of the world."""
+
+    record_dtype = dtype([("x", "<i4"), ("y", "<i4"), ("z", "<i4"),
+                          ("old_id", "u1"), ("new_id", "u1")])
+
+    # Saved logs start with a magic string, the format version and the
+    # number of records, followed by the records themselves
+    file_header = struct.Struct("<8sII")
+    file_magic = b"MCPEEDIT"
+    file_version = 1
+
+    def __init__(self):
+        self.batches = []
+
+    def __len__(self):
+        return sum([ len(batch) for batch in self.batches ])
+
+    def record(self, coords, old_data, new_data):
+        """Record the blocks at the x, y, z coordinates in an array shaped
+        (..., 3) whose IDs went from old_data to new_data. Blocks whose ID
+        did not change are skipped."""
+
+        coords = asarray(coords).reshape(-1, 3)
+        old_data = asarray(old_data).reshape(-1)
+        new_data = asarray(new_data).reshape(-1)
+
+        changed = old_data != new_data
+        if not changed.any():
+            return
+
+        batch = zeros(changed.sum(), dtype=self.record_dtype)
+        batch["x"], batch["y"], batch["z"] = coords[changed].T
+        batch["old_id"] = old_data[changed]
+        batch["new_id"] = new_data[changed]
+        self.batches.append(batch)
+
+    def mark(self):
+        """Returns a marker for the current end of the log, records made
+        after it can be retrieved by passing it as since"""
+
+        return len(self.batches)
+
+    def records(self, since=0):
+        """Returns all records in the order they were made, or only
+        those made after a mark"""
+
+        if len(self.batches) <= since:
+            return zeros(0, dtype=self.record_dtype)
+        return concatenate(self.batches[since:])
+
+    def positions(self, since=0):
+        """Returns the unique x, y, z positions of changed blocks as an
+        array shaped (N, 3), or only of those changed after a mark"""
+
+        coords = ascontiguousarray(self.coords(since))
+        if len(coords) == 0:
+            return zeros((0, 3), dtype=int)
+
+        return unique(coords.view([("", coords.dtype)] * 3)).view(coords.dtype).reshape(-1, 3)
+
+    def coords(self, since=0):
+        """Returns the x, y, z positions of all records in the order they
+        were made as an array shaped (N, 3), or only of those made after
+        a mark"""
+
+        records = self.records(since)
+        return array([records["x"], records["y"], records["z"]], dtype=int).T.reshape(-1, 3)
+
+    def replay(self, world, since=0):
+        """Apply the recorded changes to a world, giving each block the
+        ID its last record changed it to. Returns the x, y, z positions
+        of the blocks written, shaped (N, 3)."""
+
+        records = self.records(since)
+        coords = self.coords(since)
+
+        last_records = last_unique(coords)
+        write_blocks(world, coords[last_records], records["new_id"][last_records])
+        logger.debug("Replayed %d records onto %d blocks" % (len(records), len(last_records)))
+
+        return coords[last_records]
+
+    def rollback(self, world, since=0):
+        """Undo the recorded changes in a world, giving each block the ID
+        it had before its first record. Returns the x, y, z positions of
+        the blocks written, shaped (N, 3)."""
+
+        records = self.records(since)[::-1]
+        coords = self.coords(since)[::-1]
+
+        first_records = last_unique(coords)
+        write_blocks(world, coords[first_records], records["old_id"][first_records])
+        logger.debug("Rolled back %d records from %d blocks" % (len(records), len(first_records)))
+
+        return coords[first_records]
+
+    def save(self, filename):
+        """Write all records to a binary file"""
+
+        records = self.records()
+        with open(filename, "wb") as log_file:
+            log_file.write(self.file_header.pack(self.file_magic, self.file_version, len(records)))
+            log_file.write(records.astype(self.record_dtype).tobytes())
+
+        logger.info("Saved %d edit records to %s" % (len(records), filename))
+
+    @classmethod
+    def load(cls, filename):
+        """Returns an EditLog with the records of a file written by save"""
+
+        with open(filename, "rb") as log_file:
+            data = log_file.read()
+
+        if len(data) < cls.file_header.size:
+            raise ValueError("%s is too short to be an edit log" % filename)
+
+        magic, version, count = cls.file_header.unpack_from(data)
+        if magic != cls.file_magic:
+            raise ValueError("%s is not an edit log" % filename)
+        if version != cls.file_version:
+            raise ValueError("Edit log %s has unsupported version %d" % (filename, version))
+        if len(data) != cls.file_header.size + count * cls.record_dtype.itemsize:
+            raise ValueError("Edit log %s should hold %d records but its size does not match" % (filename, count))
+
+        edit_log = cls()
+        if count:
+            edit_log.batches.append(frombuffer(data, dtype=cls.record_dtype, count=count, offset=cls.file_header.size).copy())
+
+        logger.info("Loaded %d edit records from %s" % (count, filename))
+
+        return edit_log
@@ -0,0 +1,164 @@
+import logging
+
+from contextlib import contextmanager
+from threading import Lock, RLock
+
+from numpy import asarray
+
+from block_io import read_blocks, write_blocks, CHUNK_SHIFT
+import profiling
+
+logger = logging.getLogger(__name__)
+
+class EditConflict(Exception):
+    """Chunks an edit was computed from were changed by another writer
+    before the edit could be written"""
+
+    def __init__(self, chunk_positions):
+        Exception.__init__(self, "Chunks changed by another writer: %s" % ", ".join([ str(pos) for pos in chunk_positions ]))
+        self.chunk_positions = chunk_positions
+
+class EditSession(object):
+    """Sits between a world and several threads editing it at the same
+    time. Every chunk has its own lock and a version that goes up each
+    time blocks of the chunk are written, through write or through
+    write_blocks given the session as its world, so MapViews created on
+    the session keep versions up to date.
+
+    Writers either hold the locks of the chunks they work on, with
+    locked, for as long as reading and writing them takes, or edit them
+    optimistically with edit, which reads the blocks and their chunk
+    versions, computes the new blocks without holding any lock and
+    writes them only if none of the chunks changed in between, reading
+    them again and retrying when one did. Chunk locks are always taken
+    in the same order so writers locking overlapping regions can not
+    deadlock. While their locks are held chunks are pinned in worlds
+    that can release them, such as a ChunkCache, so a chunk fetched by
+    one writer is not dropped by another thread loading chunks before
+    it is marked dirty. Any attribute not handled here is passed
+    through to the world."""
+
+    def __init__(self, world):
+        self.world = world
+
+        self.chunk_locks = {}
+        self.versions = {}
+        self.conflicts = 0
+
+        # Guards the lock table and calls into the world, which is not
+        # safe to load chunks from on several threads at once
+        self.guard = Lock()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the session itself
+        return getattr(self.world, name)
+
+    def chunk_lock(self, chunk_pos):
+        with self.guard:
+            lock = self.chunk_locks.get(chunk_pos)
+            if lock is None:
+                lock = RLock()
+                self.chunk_locks[chunk_pos] = lock
+            return lock
+
+    def chunk_positions(self, coords):
+        """Returns the sorted positions of every chunk inside the x, z
+        box around the x, y, z coordinates in an array shaped (..., 3)"""
+
+        coords = asarray(coords).reshape(-1, 3).astype(int)
+        if len(coords) == 0:
+            return []
+
+        lowest = coords.min(axis=0) >> CHUNK_SHIFT
+        highest = coords.max(axis=0) >> CHUNK_SHIFT
+        return [ (cx, cz) for cx in range(lowest[0], highest[0] + 1)
+                          for cz in range(lowest[2], highest[2] + 1) ]
+
+    @contextmanager
+    def locked(self, coords):
+        """Context manager holding the locks of the chunks around the
+        coordinates, yields the positions of those chunks. The locks can
+        be taken again by the same thread, such as by write."""
+
+        chunk_positions = self.chunk_positions(coords)
+        locks = [ self.chunk_lock(chunk_pos) for chunk_pos in chunk_positions ]
+        for lock in locks:
+            lock.acquire()
+        pin = getattr(self.world, "pin", None)
+        try:
+            if pin is not None:
+                with self.guard:
+                    for chunk_pos in chunk_positions:
+                        pin(*chunk_pos)
+            yield chunk_positions
+        finally:
+            if pin is not None:
+                with self.guard:
+                    for chunk_pos in chunk_positions:
+                        self.world.unpin(*chunk_pos)
+            for lock in reversed(locks):
+                lock.release()
+
+    def version(self, chunk_pos):
+        return self.versions.get(chunk_pos, 0)
+
+    def getChunk(self, cx, cz):
+        with self.guard:
+            return self.world.getChunk(cx, cz)
+
+    def markDirty(self, cx, cz):
+        """Called by write_blocks for every chunk written"""
+
+        with self.guard:
+            self.versions[cx, cz] = self.versions.get((cx, cz), 0) + 1
+            mark_dirty = getattr(self.world, "markDirty", None)
+            if mark_dirty is not None:
+                mark_dirty(cx, cz)
+
+    def blockAt(self, x, y, z):
+        with self.locked([(x, y, z)]):
+            return self.world.blockAt(x, y, z)
+
+    def setBlockAt(self, x, y, z, blockID):
+        with self.locked([(x, y, z)]):
+            self.world.setBlockAt(x, y, z, blockID)
+            self.markDirty(x >> CHUNK_SHIFT, z >> CHUNK_SHIFT)
+
+    def read(self, coords, array_name="Blocks"):
+        """Returns the values at the x, y, z coordinates like read_blocks
+        along with the versions of their chunks to pass on to write"""
+
+        with self.locked(coords) as chunk_positions:
+            data = read_blocks(self, coords, array_name)
+            return data, dict([ (chunk_pos, self.version(chunk_pos)) for chunk_pos in chunk_positions ])
+
+    def write(self, coords, values, versions=None, array_name="Blocks", calc_lighting=True):
+        """Set the values at the x, y, z coordinates like write_blocks.
+        With the versions returned by read, raises EditConflict instead
+        of writing when any of those chunks was written since."""
+
+        with self.locked(coords):
+            if versions is not None:
+                changed = sorted([ chunk_pos for chunk_pos, version in versions.items() if self.version(chunk_pos) != version ])
+                if changed:
+                    with self.guard:
+                        self.conflicts += 1
+                    profiling.count("edit_conflicts")
+                    raise EditConflict(changed)
+            return write_blocks(self, coords, values, array_name, calc_lighting)
+
+    def edit(self, coords, update, retries=8, array_name="Blocks", calc_lighting=True):
+        """Optimistically replace the values at the x, y, z coordinates
+        with update(values), computed without holding any locks. Retries
+        up to retries times when another writer changed the chunks in the
+        meantime and raises EditConflict once out of retries. Returns the
+        values written."""
+
+        for attempt in range(retries + 1):
+            data, versions = self.read(coords, array_name)
+            try:
+                return self.write(coords, update(data), versions, array_name, calc_lighting)
+            except EditConflict:
+                if attempt == retries:
+                    raise
+                logger.debug("Edit conflict, retrying attempt %d of %d" % (attempt + 1, retries))
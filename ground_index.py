@@ -0,0 +1,139 @@
+import logging
+
+from numpy import array, asarray, zeros, cumsum, argmax, where, uint8
+
+from block_io import read_blocks
+
+logger = logging.getLogger(__name__)
+
+class GroundLevelIndex(object):
+    """Ground level of every column of a world computed once, giving the
+    same answer as find_ground_level without scanning a column of blocks
+    on every call. Like find_ground_level, the ground level of an x, z
+    column is one block below the highest layer where the fraction of
+    non air blocks in a search_size by search_size square around the
+    column reaches percent_ground. Blocks outside the world count as air.
+    Changed blocks are reported with invalidate, or with update when
+    whether they are air is already known, which only recompute the
+    columns whose search square contains them."""
+
+    def __init__(self, world, percent_ground=0.65, search_size=3):
+        self.world = world
+        self.percent_ground = percent_ground
+        self.search_size = search_size
+
+        # Columns before the searched one inside its square
+        self.search_before = search_size // 2
+
+        bb = world.getWorldBounds()
+        self.lower = array((bb.minx, bb.minz))
+        self.miny = bb.miny
+        self.height = bb.maxy - bb.miny
+        x_size, z_size = bb.maxx - bb.minx, bb.maxz - bb.minz
+
+        # Which blocks are not air indexed by x, z and y like chunks
+        self.solid = zeros((x_size, z_size, self.height), dtype=uint8)
+        for cx, cz in world.allChunks:
+            x_beg = cx * 16 - self.lower[0]
+            z_beg = cz * 16 - self.lower[1]
+            if x_beg < 0 or z_beg < 0 or x_beg >= x_size or z_beg >= z_size:
+                continue
+
+            blocks = world.getChunk(cx, cz).Blocks[:, :, bb.miny:bb.maxy]
+            x_end = min(x_beg + 16, x_size)
+            z_end = min(z_beg + 16, z_size)
+            self.solid[x_beg:x_end, z_beg:z_end, :] = blocks[:x_end-x_beg, :z_end-z_beg, :] != 0
+
+        self.levels = self.compute_levels(self.solid)
+        self.dirty = zeros((x_size, z_size), dtype=bool)
+
+    def compute_levels(self, solid):
+        """Returns the ground level of every column of a block of solid
+        values indexed by x, z and y, -1 where there is no ground"""
+
+        size = self.search_size
+        before = self.search_before
+
+        # Sum the squares around every column with cumulative sums
+        # over a padded copy of the solid values
+        x_size, z_size, y_size = solid.shape
+        padded = zeros((x_size + size, z_size + size, y_size), dtype="int32")
+        padded[before+1:before+1+x_size, before+1:before+1+z_size, :] = solid
+        sums = cumsum(cumsum(padded, axis=0), axis=1)
+        counts = sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+
+        is_ground = counts / float(size*size) >= self.percent_ground
+
+        # The highest ground layer is the first one from the top
+        top_down = is_ground[:, :, ::-1]
+        highest = y_size - 1 - argmax(top_down, axis=2)
+
+        return where(top_down.any(axis=2), highest - 1 + self.miny, -1)
+
+    def ground_level(self, x, z):
+        """Returns the ground level at an x, z column"""
+
+        x_index, z_index = array((x, z)) - self.lower
+        x_size, z_size = self.dirty.shape
+        inside = 0 <= x_index < x_size and 0 <= z_index < z_size
+
+        if inside and not self.dirty[x_index, z_index]:
+            level = self.levels[x_index, z_index]
+        else:
+            # Only the column's search square is needed
+            size = self.search_size
+            square = zeros((size, size, self.height), dtype=uint8)
+            x_beg = x_index - self.search_before
+            z_beg = z_index - self.search_before
+            x_lo, x_hi = max(x_beg, 0), min(x_beg + size, x_size)
+            z_lo, z_hi = max(z_beg, 0), min(z_beg + size, z_size)
+            if x_lo < x_hi and z_lo < z_hi:
+                square[x_lo-x_beg:x_hi-x_beg, z_lo-z_beg:z_hi-z_beg] = self.solid[x_lo:x_hi, z_lo:z_hi]
+
+            level = self.compute_levels(square)[self.search_before, self.search_before]
+            if inside:
+                self.levels[x_index, z_index] = level
+                self.dirty[x_index, z_index] = False
+
+        if level < 0:
+            raise ValueError("No ground found at x: %d z: %d" % (x, z))
+
+        return level
+
+    def invalidate(self, positions):
+        """Update the index for blocks that changed at the x, y, z
+        positions in an array shaped (N, 3), reading them from the world"""
+
+        positions = asarray(positions).reshape(-1, 3)
+        self.update(positions, read_blocks(self.world, positions) != 0)
+
+    def update(self, positions, solid):
+        """Update the index for blocks at the x, y, z positions in an
+        array shaped (N, 3) that are now solid or air as given by the
+        matching booleans in solid. Only the columns whose search square
+        contains a changed block need recomputing."""
+
+        positions = asarray(positions).reshape(-1, 3)
+        solid = asarray(solid).reshape(-1)
+        x_size, z_size = self.dirty.shape
+
+        x_index = positions[:, 0] - self.lower[0]
+        z_index = positions[:, 2] - self.lower[1]
+        y_index = positions[:, 1] - self.miny
+        inside = (x_index >= 0) & (x_index < x_size) & (z_index >= 0) & (z_index < z_size) & \
+                 (y_index >= 0) & (y_index < self.height)
+        if not inside.any():
+            return
+
+        x_index, z_index, y_index = x_index[inside], z_index[inside], y_index[inside]
+        self.solid[x_index, z_index, y_index] = solid[inside]
+
+        # A block is in the search square of the columns up to the
+        # square's size minus one before it and those after it
+        after = self.search_size - 1 - self.search_before
+        for x_off in range(-after, self.search_before + 1):
+            for z_off in range(-after, self.search_before + 1):
+                x_col = x_index + x_off
+                z_col = z_index + z_off
+                valid = (x_col >= 0) & (x_col < x_size) & (z_col >= 0) & (z_col < z_size)
+                self.dirty[x_col[valid], z_col[valid]] = True
@@ -0,0 +1,263 @@
+import logging
+
+from numpy import array, zeros, maximum, minimum, concatenate, clip, cumsum, mgrid, stack, lexsort, diff, flatnonzero, int16, uint8
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Brightest light level, light can not travel further than this
+MAX_LIGHT = 15
+
+# Widest box, in columns along x and along z, that changes are grouped
+# into for relighting, so the cost follows the size of the edit rather
+# than how far apart the changes are spread over the world
+MAX_BOX_COLUMNS = 64
+
+def box_chunks(world, x_range, z_range):
+    """Yields the chunk position of every chunk present in the world
+    that overlaps the x and z range of a box, along with the x and z
+    slices of the chunk's arrays and of the box where they overlap"""
+
+    for cx in range(x_range[0] >> 4, ((x_range[1] - 1) >> 4) + 1):
+        for cz in range(z_range[0] >> 4, ((z_range[1] - 1) >> 4) + 1):
+            if not world.containsChunk(cx, cz):
+                continue
+
+            x_beg, x_end = max(x_range[0], cx * 16), min(x_range[1], cx * 16 + 16)
+            z_beg, z_end = max(z_range[0], cz * 16), min(z_range[1], cz * 16 + 16)
+            yield ((cx, cz),
+                   (slice(x_beg - cx * 16, x_end - cx * 16), slice(z_beg - cz * 16, z_end - cz * 16)),
+                   (slice(x_beg - x_range[0], x_end - x_range[0]), slice(z_beg - z_range[0], z_end - z_range[0])))
+
+def read_box(world, x_range, z_range, y_range, array_name="Blocks"):
+    """Returns the values of a chunk array in a box indexed by x, z and y
+    like the chunk arrays are, copied a chunk at a time, along with an x
+    by z boolean matrix of the columns whose chunk is present. Columns
+    of missing chunks read as 0."""
+
+    values = zeros((x_range[1] - x_range[0], z_range[1] - z_range[0], y_range[1] - y_range[0]), dtype=uint8)
+    present = zeros(values.shape[:2], dtype=bool)
+
+    for chunk_pos, (chunk_x, chunk_z), (box_x, box_z) in box_chunks(world, x_range, z_range):
+        chunk_array = getattr(world.getChunk(*chunk_pos), array_name)
+        values[box_x, box_z, :] = chunk_array[chunk_x, chunk_z, y_range[0]:y_range[1]]
+        present[box_x, box_z] = True
+        profiling.count("chunks_read")
+
+    return values, present
+
+def write_box(world, x_range, z_range, y_range, values, update, array_name):
+    """Write the values of a box indexed by x, z and y where update is
+    true into a chunk array. Lighting changes do not mark chunks as
+    needing lighting."""
+
+    # World wrappers that track modified chunks themselves, such
+    # as ChunkCache, are told about every chunk written to
+    mark_dirty = getattr(world, "markDirty", None)
+
+    for chunk_pos, (chunk_x, chunk_z), (box_x, box_z) in box_chunks(world, x_range, z_range):
+        chunk_update = update[box_x, box_z, :]
+        if not chunk_update.any():
+            continue
+
+        chunk = world.getChunk(*chunk_pos)
+        chunk_values = getattr(chunk, array_name)[chunk_x, chunk_z, y_range[0]:y_range[1]]
+        chunk_values[chunk_update] = values[box_x, box_z, :][chunk_update]
+        chunk.chunkChanged(False)
+        if mark_dirty is not None:
+            mark_dirty(*chunk_pos)
+        profiling.count("chunks_written")
+
+def propagate_light(sources, absorption, fixed, fixed_light, above_light):
+    """Spread light through a box of blocks indexed by x, z and y. Every
+    block that is not fixed gets the brightest of its own source value
+    and the light of its neighbors reduced by the block's absorption,
+    at least by 1. Fixed blocks keep the light given to them. Light
+    above the top of the box is above_light, below the bottom it is 0."""
+
+    light = sources.astype(int16)
+    light[fixed] = fixed_light[fixed]
+    reduction = maximum(absorption, 1).astype(int16)
+    brightest = zeros(light.shape, dtype=int16)
+
+    for step in range(MAX_LIGHT):
+        brightest[...] = 0
+        brightest[1:, :, :] = maximum(brightest[1:, :, :], light[:-1, :, :])
+        brightest[:-1, :, :] = maximum(brightest[:-1, :, :], light[1:, :, :])
+        brightest[:, 1:, :] = maximum(brightest[:, 1:, :], light[:, :-1, :])
+        brightest[:, :-1, :] = maximum(brightest[:, :-1, :], light[:, 1:, :])
+        brightest[:, :, 1:] = maximum(brightest[:, :, 1:], light[:, :, :-1])
+        brightest[:, :, :-1] = maximum(brightest[:, :, :-1], light[:, :, 1:])
+        brightest[:, :, -1] = maximum(brightest[:, :, -1], above_light)
+
+        new_light = maximum(sources, clip(brightest - reduction, 0, MAX_LIGHT)).astype(int16)
+        new_light[fixed] = fixed_light[fixed]
+
+        converged = (new_light == light).all()
+        light = new_light
+        if converged:
+            break
+
+    return light
+
+def relight_box(world, x_range, y_range, z_range, fixed_columns=None):
+    """Recompute sky and block light inside of a box of the world. The
+    outer layer of the box and any columns marked in the x by z boolean
+    matrix fixed_columns are left untouched and act as the boundary for
+    the light inside of it, so the box should extend at least MAX_LIGHT
+    blocks past any changed blocks. Returns the number of light values
+    changed."""
+
+    height = world.Height
+    materials = world.materials
+
+    # Skylight falling straight down depends on every block above,
+    # so read whole columns from the bottom of the box up
+    column_blocks, present = read_box(world, x_range, z_range, (y_range[0], height))
+    column_absorption = materials.lightAbsorption[column_blocks].astype(int16)
+    absorbed_above = cumsum(column_absorption[:, :, ::-1], axis=2)[:, :, ::-1]
+    direct_sky = clip(MAX_LIGHT - absorbed_above, 0, MAX_LIGHT)
+
+    y_size = y_range[1] - y_range[0]
+    blocks = column_blocks[:, :, :y_size]
+    absorption = column_absorption[:, :, :y_size]
+    direct_sky = direct_sky[:, :, :y_size]
+    emission = materials.lightEmission[blocks].astype(int16)
+
+    # The outer layer keeps its current light, except at the top
+    # and bottom of the world which have nothing past them
+    fixed = zeros(blocks.shape, dtype=bool)
+    fixed[[0, -1], :, :] = True
+    fixed[:, [0, -1], :] = True
+    if y_range[0] > 0:
+        fixed[:, :, 0] = True
+    if y_range[1] < height:
+        fixed[:, :, -1] = True
+    if fixed_columns is not None:
+        fixed |= fixed_columns[:, :, None]
+
+    # Columns in chunks missing from the world have no light to change
+    fixed |= ~present[:, :, None]
+
+    # Light above the box only matters when the box reaches the sky
+    open_sky = MAX_LIGHT if y_range[1] >= height else 0
+
+    changed = 0
+    for array_name, sources, above_light in (("SkyLight", direct_sky, open_sky), ("BlockLight", emission, 0)):
+        old_light = read_box(world, x_range, z_range, y_range, array_name)[0]
+        new_light = propagate_light(sources, absorption, fixed, old_light, above_light)
+
+        update = new_light != old_light
+        count = int(update.sum())
+        if count:
+            write_box(world, x_range, z_range, y_range, new_light, update, array_name)
+            changed += count
+
+    return changed
+
+def near_columns(columns, x_range, z_range, distance):
+    """Returns a boolean matrix over the x and z range of a box which is
+    true for columns within the given distance of any of the x, z
+    columns in an array shaped (N, 2)"""
+
+    x_size = x_range[1] - x_range[0]
+    z_size = z_range[1] - z_range[0]
+
+    marked = zeros((x_size + 2 * distance + 1, z_size + 2 * distance + 1), dtype=int)
+    marked[columns[:, 0] - x_range[0] + distance + 1, columns[:, 1] - z_range[0] + distance + 1] = 1
+
+    # Count marked columns inside a window around each column using
+    # cumulative sums, any count above zero means one is close by
+    window = 2 * distance + 1
+    counts = cumsum(cumsum(marked, axis=0), axis=1)
+    counts = counts[window:, window:] - counts[:-window, window:] - counts[window:, :-window] + counts[:-window, :-window]
+    return counts[:x_size, :z_size] > 0
+
+def relight_blocks(world, positions):
+    """Update sky and block light around changed blocks given as an array
+    of x, y, z positions shaped (N, 3). Only columns within reach of the
+    changed blocks are relit, from the bottom of the world up to as far
+    as light can travel above the highest change, instead of relighting
+    whole chunks."""
+
+    positions = array(positions).reshape(-1, 3)
+    if len(positions) == 0:
+        return 0
+
+    height = world.Height
+
+    # Start with a box around the changes in each chunk, then sweep
+    # through them in order of their lowest x merging boxes that overlap
+    # as long as the merged box stays within MAX_BOX_COLUMNS
+    order = lexsort((positions[:, 2] >> 4, positions[:, 0] >> 4))
+    positions = positions[order]
+    chunk_keys = positions[:, [0, 2]] >> 4
+    starts = concatenate(([0], flatnonzero((diff(chunk_keys, axis=0) != 0).any(axis=1)) + 1, [len(positions)]))
+
+    clusters = []
+    for beg, end in zip(starts[:-1], starts[1:]):
+        in_chunk = positions[beg:end]
+        clusters.append((in_chunk.min(axis=0) - MAX_LIGHT - 1, in_chunk.max(axis=0) + MAX_LIGHT + 2, [ in_chunk ]))
+    clusters.sort(key=lambda cluster: cluster[0][0])
+
+    boxes = []
+    active = []
+    for lower, upper, in_cluster in clusters:
+        # Boxes ending before this one starts can not overlap any later one
+        active = [ index for index in active if boxes[index][1][0] > lower[0] ]
+
+        for index in active:
+            box_lower, box_upper, in_box = boxes[index]
+            merged_lower, merged_upper = minimum(box_lower, lower), maximum(box_upper, upper)
+            if (box_lower < upper).all() and (lower < box_upper).all() and \
+               (merged_upper - merged_lower)[[0, 2]].max() <= MAX_BOX_COLUMNS:
+                boxes[index] = (merged_lower, merged_upper, in_box + in_cluster)
+                break
+        else:
+            boxes.append((lower, upper, in_cluster))
+            active.append(len(boxes) - 1)
+
+    # Boxes are relit one after another using the light around them as
+    # it is at the time, so a box overlapping one relit after it is
+    # relit once more to take in the light that reached it from there
+    lowers = array([ lower for lower, upper, in_box in boxes ])
+    uppers = array([ upper for lower, upper, in_box in boxes ])
+    overlapping = ((lowers[:, None, [0, 2]] < uppers[None, :, [0, 2]]) &
+                   (lowers[None, :, [0, 2]] < uppers[:, None, [0, 2]])).all(axis=-1)
+    relit_again = [ index for index in range(len(boxes)) if overlapping[index, index+1:].any() ]
+
+    changed = 0
+    for index in list(range(len(boxes))) + relit_again:
+        lower, upper, in_box = boxes[index]
+        in_box = concatenate(in_box)
+        x_range = (int(lower[0]), int(upper[0]))
+        z_range = (int(lower[2]), int(upper[2]))
+
+        # Direct skylight can change anywhere below a changed block
+        y_range = (0, int(min(upper[1], height)))
+
+        near = near_columns(in_box[:, [0, 2]], x_range, z_range, MAX_LIGHT)
+        changed += relight_box(world, x_range, y_range, z_range, fixed_columns=~near)
+
+    logger.debug("Relit %d light values around %d changed blocks", changed, len(positions))
+    profiling.count("light_boxes", len(boxes) + len(relit_again))
+    profiling.count("light_values_changed", changed)
+
+    return changed
+
+def relight_chunks(world, chunk_positions):
+    """Relight every column of the chunks at the given cx, cz chunk
+    positions, the way a full chunk relight would"""
+
+    if len(chunk_positions) == 0:
+        return 0
+
+    # Every column of each chunk from the bottom to the top of the world
+    x_off, z_off = mgrid[0:16, 0:16].reshape(2, -1)
+    positions = []
+    for cx, cz in chunk_positions:
+        for y in (0, world.Height - 1):
+            positions.append(stack([cx * 16 + x_off, zeros(x_off.shape, dtype=int) + y, cz * 16 + z_off], axis=-1))
+
+    return relight_blocks(world, concatenate(positions))
@@ -5,15 +5,25 @@ import sys
 import logging
 from optparse import OptionParser
 
-from numpy import round, mod, random
 from math import degrees, radians, floor
+from timeit import default_timer
 
-from map_view import MapView
-from utils import load_world_and_player, get_player_pos_yaw
-from caving import *
+import profiling
 
-def player_tunnel(world, player, **kwargs):
-    """Make a tunnel starting at player locating in the same visual direction"""
+# The carving code along with numpy, pymclevel and opennbt is imported
+# by the functions using it, so that parsing the command line and
+# batch jobs on small worlds do not wait on importing all of it
+
+logger = logging.getLogger(__name__)
+
+def player_tunnel(world, player, view_class=None, **kwargs):
+    """Make a tunnel starting at player locating in the same visual
+    direction, carved with a view of view_class, MapView by default"""
+
+    from numpy import round
+    from map_view import MapView
+    from caving import make_cave, tunnel_pattern
+    from utils import get_player_pos_yaw
 
     # Extract player posistion and yaw from NBT file
     player_pos, player_yaw = get_player_pos_yaw(player)
@@ -22,7 +32,8 @@ def player_tunnel(world, player, **kwargs):
     player_yaw = radians(90*round(degrees(player_yaw)/90))
 
     # Set up view object we will use to move through the world
-    cave_view = MapView(world, tunnel_pattern.shape, player_pos, yaw=player_yaw)
+    view_class = view_class or MapView
+    cave_view = view_class(world, tunnel_pattern.shape, player_pos, yaw=player_yaw)
 
     # Move starting point centered in front of player, 
     # a bit in front and a bit down
@@ -30,21 +41,293 @@ def player_tunnel(world, player, **kwargs):
 
     make_cave(cave_view, tunnel_pattern, **kwargs)
     
-def random_subsurface(world, pattern, **kwargs):
-    """Creates a sub surface tunnel starting at a random location"""
+def random_subsurface(world, pattern, ground_index=None, rng=None, view_class=None, **kwargs):
+    """Creates a sub surface tunnel starting at a random location, carved
+    with a view of view_class, MapView by default"""
 
-    bb = world.getWorldBounds()
-    x_start = random.randint(bb.minx, bb.maxx)
-    z_start = random.randint(bb.minz, bb.maxz)
-    y_start = find_ground_level(world, (x_start, z_start))
+    from map_view import MapView
+    from caving import make_cave, random_start
+    from edit_log import EditLog
+    from rng import make_rng
 
-    start_pos = (x_start, y_start, z_start)
-    start_yaw = radians(random.randint(0, 4) * 90)
+    rng = make_rng(rng)
+    kwargs["rng"] = rng
+
+    start_pos, start_yaw = random_start(world, ground_index, rng=rng)
     logger.info("Beginning random subsurface tunnel at: %s %f deg" % (start_pos, degrees(start_yaw)))
 
-    cave_view = MapView(world, pattern.shape, start_pos, yaw=start_yaw)
+    view_class = view_class or MapView
+    cave_view = view_class(world, pattern.shape, start_pos, yaw=start_yaw)
+
+    if ground_index is None:
+        make_cave(cave_view, pattern, **kwargs)
+        return
 
+    # Keep the ground level index up to date with the blocks changed
+    if kwargs.get("edit_log") is None:
+        kwargs["edit_log"] = EditLog()
+    mark = kwargs["edit_log"].mark()
     make_cave(cave_view, pattern, **kwargs)
+    ground_index.invalidate(kwargs["edit_log"].positions(since=mark))
+
+def carve_world(w_file, tunnel_at_player=False, num_random_tunnels=0, num_lava_tubes=0, num_water_tubes=0,
+                seed=None, jobs=1, two_phase=False, chunk_cache=64, full_relight=False, use_mmap=False,
+                edit_log_file=None, merge_tunnels=False, max_branches=None, max_blocks=None,
+                preview_file=None, pattern_library=None, tunnel_patterns=None, pattern_cache=None,
+                pose_views=False):
+    """Carve caves into the world at w_file and save it in place. The
+    arguments match the command line options of this script, with
+    tunnel_at_player for --player_tunnel, use_mmap for --mmap and
+    edit_log_file for --edit_log. With merge_tunnels caves carved one
+    after another stop when they run into an earlier one. The branches and
+    blocks carved by each cave are limited by max_branches and max_blocks
+    when they are given. With preview_file the caves are carved into a
+    read only memory mapped copy of the world, which is neither relit nor
+    saved, and a top-down picture of them is written to preview_file
+    instead. Random tunnels are carved with patterns picked at random from
+    the files or directories in pattern_library, or from those it names in
+    tunnel_patterns, instead of the built in tunnel pattern, either may
+    also be a single path or a comma separated string of names. Compiled
+    library patterns are cached in pattern_cache, a .pattern_cache
+    directory next to the first library by default. With pose_views caves
+    are carved with PoseMapViews, which keep exact coordinates where a
+    MapView truncates them, so after turning a tunnel can be a block away
+    from where the default MapView puts it. Caves planned with two_phase
+    always use pose views, they match a run carved one at a time with
+    pose_views. Seed is an integer
+    seed or a numpy Generator or RandomState, without one numpy's global
+    random state is used. Returns a dictionary with the number of blocks
+    changed and the seconds each phase took."""
+
+    # Modules only some of the options need are imported where they
+    # are used
+    from caving import tunnel_pattern, lava_tube, water_tube
+    from edit_log import EditLog
+    from rng import make_rng
+    from utils import load_world, load_player
+
+    # Only tunnels carved one after another know about each other, and
+    # planned caves are not limited
+    if merge_tunnels and (jobs > 1 or two_phase):
+        raise ValueError("Merging tunnels needs them carved one at a time, not with jobs or two_phase")
+    if two_phase and (max_branches is not None or max_blocks is not None):
+        raise ValueError("Branch and block limits do not apply to two_phase planning")
+
+    timings = {}
+    start = phase_start = default_timer()
+
+    rng = make_rng(seed)
+
+    # Bad pattern files are found before the world is touched
+    library = None
+    if pattern_library:
+        from pattern_library import PatternLibrary
+
+        if not isinstance(pattern_library, (list, tuple)):
+            pattern_library = [ pattern_library ]
+        if tunnel_patterns and not isinstance(tunnel_patterns, (list, tuple)):
+            tunnel_patterns = tunnel_patterns.split(",")
+
+        if pattern_cache is None:
+            first = pattern_library[0]
+            pattern_cache = os.path.join(first if os.path.isdir(first) else os.path.dirname(first), ".pattern_cache")
+        library = PatternLibrary(cache_dir=pattern_cache)
+        for path in pattern_library:
+            library.load(path)
+
+        tunnel_patterns = tunnel_patterns or library.names()
+        if not tunnel_patterns:
+            raise ValueError("No patterns found in %s" % ", ".join(pattern_library))
+        tunnel_patterns = [ library[name] for name in tunnel_patterns ]
+
+    # Load world and, only when it is needed, the player
+    # file (level.dat) from the same place
+    if preview_file:
+        from pocket_mmap import load_readonly
+        from preview import heightmap
+
+        world = load_readonly(w_file)
+        heights = heightmap(world)
+    else:
+        world = load_world(w_file, use_mmap=use_mmap)
+    player = load_player(world) if tunnel_at_player else None
+
+    # Limit how many chunks stay loaded while carving
+    if chunk_cache > 0:
+        from chunk_cache import ChunkCache
+        world = ChunkCache(world, max_bytes=chunk_cache * 1024 * 1024)
+
+    timings["load"] = default_timer() - phase_start
+    phase_start = default_timer()
+
+    # Keep track of every block changed so only those need relighting
+    edit_log = EditLog()
+
+    # Tunnels carved so far so that later caves can stop where they
+    # run into them instead of carving through them
+    cave_options = {}
+    if max_branches is not None:
+        cave_options["max_branches"] = max_branches
+    if max_blocks is not None:
+        cave_options["max_blocks"] = max_blocks
+    limits = dict(cave_options)
+    if merge_tunnels:
+        from cave_network import CaveNetwork
+        cave_options["network"] = CaveNetwork(world.Height)
+
+    if pose_views:
+        from map_view import PoseMapView as view_class
+    else:
+        from map_view import MapView as view_class
+
+    if tunnel_at_player:
+        logger.info("Constructing tunnel at player location")
+        player_tunnel(world, player, view_class=view_class, edit_log=edit_log, rng=rng, **cave_options)
+
+    if library is None:
+        random_patterns = [tunnel_pattern] * num_random_tunnels
+    else:
+        random_patterns = [ tunnel_patterns[rng.randint(0, len(tunnel_patterns))] for count in range(num_random_tunnels) ]
+
+    patterns = random_patterns + \
+               [lava_tube] * num_lava_tubes + \
+               [water_tube] * num_water_tubes
+
+    # Find ground levels for random start points without scanning columns
+    ground_index = None
+    if patterns:
+        from ground_index import GroundLevelIndex
+
+        logger.info("Indexing ground levels")
+        ground_index = GroundLevelIndex(world)
+
+    if jobs > 1:
+        from parallel_caves import parallel_tunnels
+        from pocket_mmap import load_readonly
+
+        # Workers carve into their own copy of the world loaded from disk,
+        # the tunnel at the player is replayed onto it from the edit log
+        loader = load_readonly if use_mmap or preview_file else load_world
+        parallel_tunnels(world, w_file, patterns, processes=jobs, loader=loader,
+                         ground_index=ground_index, edit_log=edit_log, rng=rng, view_class=view_class, **limits)
+    elif two_phase:
+        from cave_planner import plan_random_caves, apply_plans
+
+        logger.info("Planning %d random caves" % len(patterns))
+        plans = plan_random_caves(world, patterns, ground_index=ground_index, rng=rng)
+        logger.info("Carving planned caves")
+        apply_plans(world, plans, edit_log)
+    else:
+        for count, pattern in enumerate(random_patterns):
+            logger.info("Creating random subsurface tunnel #%d" % (count+1))
+            random_subsurface(world, pattern, ground_index=ground_index, edit_log=edit_log, rng=rng,
+                              view_class=view_class, **cave_options)
+
+        for count in range(num_lava_tubes):
+            logger.info("Creating random subsurface lava tubes #%d" % (count+1))
+            random_subsurface(world, lava_tube, ground_index=ground_index, edit_log=edit_log, rng=rng,
+                              view_class=view_class, **cave_options)
+
+        for count in range(num_water_tubes):
+            logger.info("Creating random subsurface water tubes #%d" % (count+1))
+            random_subsurface(world, water_tube, ground_index=ground_index, edit_log=edit_log, rng=rng,
+                              view_class=view_class, **cave_options)
+
+    timings["carve"] = default_timer() - phase_start
+
+    # Blocks changed more than once are counted and relit once
+    positions = edit_log.positions()
+
+    if preview_file:
+        from preview import render_preview, save_preview
+
+        # Lighting makes no difference seen from above
+        phase_start = default_timer()
+        bb = world.getWorldBounds()
+        save_preview(preview_file, render_preview(heights, edit_log, world.Height, (bb.minx, bb.minz)))
+        timings["preview"] = default_timer() - phase_start
+    else:
+        relight_and_save(world, positions, full_relight, timings)
+    timings["total"] = default_timer() - start
+
+    # Keep the changes so they can be replayed or rolled back later
+    if edit_log_file:
+        edit_log.save(edit_log_file)
+
+    if chunk_cache > 0:
+        logger.info("Chunk cache: %s" % world.stats())
+
+    result = { "changed_blocks": len(positions),
+               "timings": timings,
+               }
+    if merge_tunnels:
+        result["network"] = cave_options["network"].summary()
+        logger.info("Cave network: %s" % result["network"])
+
+    return result
+
+def relight_and_save(world, positions, full_relight, timings):
+    """Relight around the changed x, y, z positions, or every modified
+    chunk with full_relight, then save the world in place. The seconds
+    each takes are added to timings."""
+
+    from lighting import relight_blocks
+
+    phase_start = default_timer()
+
+    if full_relight:
+        # Generate lights for dirty chunks
+        logger.info("Generating lights")
+        world.generateLights()
+    else:
+        logger.info("Relighting around %d changed blocks" % len(positions))
+        relight_blocks(world, positions)
+
+    timings["relight"] = default_timer() - phase_start
+    phase_start = default_timer()
+
+    # Save our changes
+    logger.info("Writing changes in place")
+    world.saveInPlace()
+
+    timings["save"] = default_timer() - phase_start
+
+def replay_world(w_file, edit_log_file, rollback=False, chunk_cache=64, full_relight=False, use_mmap=False):
+    """Apply the changes of an edit log saved by carve_world to the world
+    at w_file, or undo them with rollback, and save it in place. Returns
+    a dictionary with the number of blocks written and the seconds each
+    phase took."""
+
+    from edit_log import EditLog
+    from utils import load_world
+
+    timings = {}
+    start = phase_start = default_timer()
+
+    edit_log = EditLog.load(edit_log_file)
+    world = load_world(w_file, use_mmap=use_mmap)
+    if chunk_cache > 0:
+        from chunk_cache import ChunkCache
+        world = ChunkCache(world, max_bytes=chunk_cache * 1024 * 1024)
+
+    timings["load"] = default_timer() - phase_start
+    phase_start = default_timer()
+
+    if rollback:
+        logger.info("Rolling back %d edits" % len(edit_log))
+        positions = edit_log.rollback(world)
+    else:
+        logger.info("Replaying %d edits" % len(edit_log))
+        positions = edit_log.replay(world)
+
+    timings["carve"] = default_timer() - phase_start
+
+    relight_and_save(world, positions, full_relight, timings)
+    timings["total"] = default_timer() - start
+
+    return { "changed_blocks": len(positions),
+             "timings": timings,
+             }
 
 def standalone_main():
     parser = OptionParser("[options] <world_filename>")
@@ -68,6 +351,83 @@ def standalone_main():
                       dest="num_water_tubes", default=0,
                       help="Number of water tubes to make")
 
+    parser.add_option("-s", "--seed",
+                      type="int",
+                      dest="seed", default=None,
+                      help="Seed for the random number generator so runs can be repeated")
+
+    parser.add_option("-e", "--edit_log",
+                      dest="edit_log", default=None,
+                      help="File to save the log of changed blocks to")
+
+    parser.add_option("--replay",
+                      dest="replay", default=None,
+                      help="Apply the changes of a saved edit log instead of carving new caves")
+
+    parser.add_option("--rollback",
+                      dest="rollback", default=None,
+                      help="Undo the changes of a saved edit log instead of carving new caves")
+
+    parser.add_option("--pattern_library",
+                      action="append", dest="pattern_library", default=None,
+                      help="Pattern file (.npy or text grid) or directory of them to carve random tunnels with, can be given more than once")
+
+    parser.add_option("--tunnel_patterns",
+                      dest="tunnel_patterns", default=None,
+                      help="Comma separated names of the library patterns to pick random tunnels from, defaults to all of them")
+
+    parser.add_option("--pattern_cache",
+                      dest="pattern_cache", default=None,
+                      help="Directory to cache compiled library patterns in, defaults to .pattern_cache next to the first library")
+
+    parser.add_option("--merge_tunnels",
+                      action="store_true", dest="merge_tunnels", default=False,
+                      help="Stop tunnels carved one at a time where they run into an earlier one")
+
+    parser.add_option("--preview",
+                      dest="preview", default=None,
+                      help="Dry run writing a top-down picture of the caves to a PNG, or .npy, file without modifying the world")
+
+    parser.add_option("--max_branches",
+                      type="int",
+                      dest="max_branches", default=None,
+                      help="Most branches carved by each cave")
+
+    parser.add_option("--max_blocks",
+                      type="int",
+                      dest="max_blocks", default=None,
+                      help="Most blocks carved by each cave including its branches")
+
+    parser.add_option("-j", "--jobs",
+                      type="int",
+                      dest="jobs", default=1,
+                      help="Number of processes used to carve random tunnels, lava and water tubes")
+
+    parser.add_option("--two_phase",
+                      action="store_true", dest="two_phase", default=False,
+                      help="Plan all random tunnels before carving them in a single pass, always with pose views")
+
+    parser.add_option("--pose_views",
+                      action="store_true", dest="pose_views", default=False,
+                      help="Carve with views that only keep their position and orientation, faster but after turning tunnels can be a block away from where the default views put them")
+
+    parser.add_option("-c", "--chunk_cache",
+                      type="int",
+                      dest="chunk_cache", default=64,
+                      help="Megabytes of unmodified chunks to keep loaded, 0 to disable the chunk cache")
+
+    parser.add_option("--full_relight",
+                      action="store_true", dest="full_relight", default=False,
+                      help="Relight every modified chunk completely instead of only around carved blocks")
+
+    parser.add_option("-m", "--mmap",
+                      action="store_true", dest="mmap", default=False,
+                      help="Memory map chunks.dat, loading chunks as they are used and saving only modified ones")
+
+    parser.add_option("--profile",
+                      dest="profile", default=None,
+                      help="File to write JSON counters and timings of the run to, worker processes are not counted")
+
     parser.add_option("-v", "--verbose",
                       action="store_true", dest="verbose", default=False,
                       help="print debugging values")
@@ -86,32 +446,54 @@ def standalone_main():
     if len(args) < 1:
         parser.error("Must specify world file location or filename.")
 
-    # Load world and player file (level.dat) from same place
-    world, player = load_world_and_player(args[0])
-    
-    if options.player_tunnel:
-        logger.info("Constructing tunnel at player location")
-        player_tunnel(world, player)
+    if options.replay and options.rollback:
+        parser.error("Can not both replay and roll back an edit log.")
 
-    for count in range(options.num_random_tunnels):
-        logger.info("Creating random subsurface tunnel #%d" % (count+1))
-        random_subsurface(world, tunnel_pattern)
+    if options.tunnel_patterns and not options.pattern_library:
+        parser.error("Tunnel patterns are picked from a pattern library.")
 
-    for count in range(options.num_lava_tubes):
-        logger.info("Creating random subsurface lava tubes #%d" % (count+1))
-        random_subsurface(world, lava_tube)
+    if options.merge_tunnels and (options.jobs > 1 or options.two_phase):
+        parser.error("Can not merge tunnels carved by several jobs or planned in two phases.")
 
-    for count in range(options.num_water_tubes):
-        logger.info("Creating random subsurface water tubes #%d" % (count+1))
-        random_subsurface(world, water_tube)
+    if options.two_phase and (options.max_branches is not None or options.max_blocks is not None):
+        parser.error("Can not limit branches or blocks of caves planned in two phases.")
 
-    # Generate lights for dirty chunks
-    logger.info("Generating lights")
-    world.generateLights()
+    # Count and time the hot paths only when asked to
+    if options.profile:
+        profiling.enable()
 
-    # Save our changes
-    logger.info("Writing changes in place")
-    world.saveInPlace()
+    if options.replay or options.rollback:
+        result = replay_world(args[0], options.replay or options.rollback,
+                              rollback=bool(options.rollback),
+                              chunk_cache=options.chunk_cache,
+                              full_relight=options.full_relight,
+                              use_mmap=options.mmap)
+    else:
+        result = carve_world(args[0],
+                             tunnel_at_player=options.player_tunnel,
+                             num_random_tunnels=options.num_random_tunnels,
+                             num_lava_tubes=options.num_lava_tubes,
+                             num_water_tubes=options.num_water_tubes,
+                             seed=options.seed,
+                             jobs=options.jobs,
+                             two_phase=options.two_phase,
+                             chunk_cache=options.chunk_cache,
+                             full_relight=options.full_relight,
+                             use_mmap=options.mmap,
+                             edit_log_file=options.edit_log,
+                             merge_tunnels=options.merge_tunnels,
+                             max_branches=options.max_branches,
+                             max_blocks=options.max_blocks,
+                             preview_file=options.preview,
+                             pattern_library=options.pattern_library,
+                             tunnel_patterns=options.tunnel_patterns,
+                             pattern_cache=options.pattern_cache,
+                             pose_views=options.pose_views)
+
+    if options.profile:
+        for phase, seconds in result["timings"].items():
+            profiling.add_time("phase." + phase, seconds)
+        profiling.profiler.dump(options.profile)
 
     # Remove the logger handler so if we rerun in ipython
     # we dont start getting duplicate log messages
@@ -1,7 +1,10 @@
 import logging
 
 from math import sin, cos, radians, degrees, pi, floor
-from numpy import array, zeros, dot, round, all
+from numpy import array, zeros, arange, identity, dot, einsum, round, all
+
+from block_io import read_blocks, write_blocks
+import profiling
 
 logger = logging.getLogger(__file__)
 
@@ -55,9 +58,9 @@ class MapView(object):
         as possible. If the shape of the view is odd in a 
         dimension then it will be the real center point."""
 
-        z_cen = floor(self.view.shape[0] / 2.0)
-        y_cen = floor(self.view.shape[1] / 2.0)
-        x_cen = floor(self.view.shape[2] / 2.0)
+        z_cen = int(floor(self.view.shape[0] / 2.0))
+        y_cen = int(floor(self.view.shape[1] / 2.0))
+        x_cen = int(floor(self.view.shape[2] / 2.0))
 
         return self.view[z_cen, y_cen, x_cen, :3]
 
@@ -70,16 +73,16 @@ class MapView(object):
 
         z_size, y_size, x_size = self.view.shape[:3]
 
-        z_world = z_beg
-        for z_view in range(0, z_size):
-            y_world = y_beg
-            for y_view in range(y_size-1, -1, -1):
-                x_world = x_beg
-                for x_view in range(x_size-1, -1, -1):
-                    self.view[z_view, y_view, x_view, :] = (x_world, y_world, z_world, 1)
-                    x_world += x_inc
-                y_world += y_inc
-            z_world += z_inc
+        # Distance of each view index from where the world coordinates
+        # begin, y and x count down from the end of their dimension
+        z_steps = arange(z_size).reshape(z_size, 1, 1)
+        y_steps = arange(y_size-1, -1, -1).reshape(1, y_size, 1)
+        x_steps = arange(x_size-1, -1, -1).reshape(1, 1, x_size)
+
+        self.view[..., 0] = x_beg + x_steps * x_inc
+        self.view[..., 1] = y_beg + y_steps * y_inc
+        self.view[..., 2] = z_beg + z_steps * z_inc
+        self.view[..., 3] = 1
 
         return self.view
 
@@ -88,14 +91,15 @@ class MapView(object):
 
         if len(Tmatrix.shape) != 2 and Tmatrix.shape != (4, 4):
             raise Exception("Tmatrix must be of shape (4, 4), not: %s" % Tmatrix.shape)
-        
-        for z_view in range(self.view.shape[0]):
-            for y_view in range(self.view.shape[1]):
-                for x_view in range(self.view.shape[2]):
-                    self.view[z_view, y_view, x_view, :] = dot(Tmatrix, self.view[z_view, y_view, x_view, :])
+
+        profiling.count("transforms")
+
+        # Transform every coordinate vector at once, the result is
+        # truncated back into the integer view the same way assigning
+        # each dot product individually would be
+        self.view[...] = einsum('ij,...j->...i', Tmatrix, self.view)
 
         return self.view
-            
 
     @classmethod
     def translation_matrix(cls, displacement):
@@ -178,21 +182,19 @@ class MapView(object):
         with the Minecraft block IDs at the points represented
         in the view matrix"""
 
-        if set_val != None and tuple(set_val.shape) != tuple(self.view.shape[:3]):
+        if set_val is not None and tuple(set_val.shape) != tuple(self.view.shape[:3]):
             raise Exception("set_val must have shape of %s to match view shape, not: %s" % (self.view.shape[:3], set_val.shape))
 
-        out_data = zeros(self.view.shape[:3], dtype=int)
+        # Blocks are read and written a whole chunk at a time
+        if set_val is not None:
+            return write_blocks(self.world, self.view[..., :3], set_val)
+        return read_blocks(self.world, self.view[..., :3])
 
-        for z_view in range(self.view.shape[0]):
-            for y_view in range(self.view.shape[1]):
-                for x_view in range(self.view.shape[2]):
-                    world_pos = [ round(p) for p in self.view[z_view, y_view, x_view, :3] ]
-                    if set_val != None:
-                        new_v = set_val[z_view, y_view, x_view]
-                        self.world.setBlockAt(world_pos[0], world_pos[1], world_pos[2], new_v)
-                    out_data[z_view, y_view, x_view] = self.world.blockAt(*world_pos)
+    def pattern_coords(self, compiled):
+        """Returns the x, y, z coordinates, shaped (N, 3), of the view
+        blocks a CompiledPattern sets"""
 
-        return out_data
+        return self.view[..., :3][compiled.where_set]
 
     def bounds_matrix(self):
         """Create a matrix the same size as the view matrix where
@@ -200,18 +202,174 @@ class MapView(object):
         otherwise"""
 
         bb = self.world.getWorldBounds()
-        
-        view_in_bounds = zeros(self.view.shape[:3], dtype=bool)
-        for z_view in range(self.view.shape[0]):
-            for y_view in range(self.view.shape[1]):
-                for x_view in range(self.view.shape[2]):
-                    view_in_bounds[z_view, y_view, x_view] = \
-                        bb.minx <= self.view[z_view, y_view, x_view, 0] < bb.maxx and \
-                        bb.miny <= self.view[z_view, y_view, x_view, 1] < bb.maxy and \
-                        bb.minz <= self.view[z_view, y_view, x_view, 2] < bb.maxz
-        return view_in_bounds
+        lower = array((bb.minx, bb.miny, bb.minz))
+        upper = array((bb.maxx, bb.maxy, bb.maxz))
+
+        coords = self.view[..., :3]
+        return ((coords >= lower) & (coords < upper)).all(axis=-1)
 
     def in_bounds(self):
         "Returns true if all points are within the bounds of the world"
-        return all(self.bounds_matrix())
-                        
+
+        bb = self.world.getWorldBounds()
+        coords = self.view[..., :3].reshape(-1, 3)
+        lowest = coords.min(axis=0)
+        highest = coords.max(axis=0)
+        return bool(all(lowest >= (bb.minx, bb.miny, bb.minz)) and all(highest < (bb.maxx, bb.maxy, bb.maxz)))
+
+    def check_step(self):
+        """Evaluate everything a caving step needs to know about the view
+        with a single read of its blocks. Returns a tuple of whether the
+        view is in bounds, whether all of its blocks are air, whether any
+        of them is bedrock and the block data itself. When the view is out
+        of bounds nothing is read, the other verdicts are False and the
+        data is None."""
+
+        if not self.in_bounds():
+            return False, False, False, None
+
+        data = self.map_data()
+        all_air = not data.any()
+        hit_bedrock = bool((data == self.world.materials.Bedrock.ID).any())
+        return True, all_air, hit_bedrock, data
+
+
+class PoseMapView(MapView):
+    """A MapView that only stores its pose instead of a full grid of
+    coordinates. The pose is the world position of the view's center
+    block and an orientation limited to multiples of 90 deg. Block
+    coordinates are computed on demand from a table of offsets around
+    the center, which is cached per view shape and orientation, so
+    moving or cloning the view costs the same regardless of its size.
+    Since the pose is kept in integers, coordinates are exact instead
+    of being truncated from floating point transformations. A MapView
+    truncates values like 13.999999 down, so after it turns by 180 or
+    270 deg its blocks, and with them origin_position and
+    center_position, can be a block away from those of a PoseMapView
+    given the same moves. Caves carved with either view therefore differ
+    once they turn."""
+
+    # Offsets of every view block from the center block keyed
+    # by view shape and orientation
+    _offset_cache = {}
+
+    def __init__(self, world, view_shape, pos=(0,0,0), yaw=0, pitch=0):
+        """Create a new view into the Minecraft world given the world
+        object, size of the view and optionally a initial position,
+        yaw and pitch. Rotations must be multiples of 90 deg."""
+
+        if len(view_shape) != 3:
+            raise Exception("view_shape must be 3 numbers z size, y size and x size")
+
+        self.world = world
+        self.shape = tuple([ int(s) for s in view_shape ])
+
+        self.pos = pos
+        self.set_position(self.pos)
+
+        self.yaw = 0
+        self.rotate_y(yaw)
+
+        self.pitch = 0
+        self.rotate_x(pitch)
+
+        logger.debug("Created pose view at position %s with yaw %s" % (self.pos, degrees(self.yaw)))
+
+    def clone(self):
+        """Return a copy of the current view, only the pose is copied"""
+
+        view = PoseMapView.__new__(PoseMapView)
+        view.__dict__.update(self.__dict__)
+        view.center = self.center.copy()
+        return view
+
+    @property
+    def view(self):
+        """Coordinate matrix equivalent to the one a MapView keeps,
+        computed from the current pose"""
+
+        if self._view is None:
+            view = zeros(self.shape + (4,), dtype=int)
+            view[..., :3] = self.center + self.offsets()
+            view[..., 3] = 1
+            self._view = view
+        return self._view
+
+    def offsets(self):
+        """Returns the offsets of all view blocks from the center block
+        for the current orientation"""
+
+        return PoseMapView.pose_offsets(self.shape, self.rotation)
+
+    @classmethod
+    def pose_offsets(cls, shape, rotation):
+        """Returns the offsets of all blocks from the center block of a
+        view with the given shape and 3x3 integer rotation matrix"""
+
+        shape = tuple(shape)
+        key = (shape, rotation.tobytes())
+        offsets = cls._offset_cache.get(key)
+        if offsets is None:
+            z_size, y_size, x_size = shape
+            z_cen, y_cen, x_cen = [ s // 2 for s in shape ]
+
+            # Unrotated offsets follow the same layout as set_position,
+            # y and x decrease along their view dimensions
+            unrotated = zeros(shape + (3,), dtype=int)
+            unrotated[..., 0] = (x_cen - arange(x_size)).reshape(1, 1, x_size)
+            unrotated[..., 1] = (y_cen - arange(y_size)).reshape(1, y_size, 1)
+            unrotated[..., 2] = (arange(z_size) - z_cen).reshape(z_size, 1, 1)
+
+            offsets = einsum('ij,...j->...i', rotation, unrotated)
+            offsets.setflags(write=False)
+            cls._offset_cache[key] = offsets
+        return offsets
+
+    def pattern_coords(self, compiled):
+        """Returns the x, y, z coordinates, shaped (N, 3), of the view
+        blocks a CompiledPattern sets, without building the full view"""
+
+        return self.center + compiled.offsets(self.rotation)
+
+    def origin_position(self):
+        """Returns position from which the view originates,
+        ie: The bottom right corner of the 0th z dimension"""
+
+        return self.center + self.offsets()[0, -1, -1]
+
+    def center_position(self):
+        """Returns position nearest to the center of the view
+        as possible. If the shape of the view is odd in a 
+        dimension then it will be the real center point."""
+
+        return self.center.copy()
+
+    def set_position(self, pos):
+        """Place the view so that it originates at the given position
+        with the default orientation"""
+
+        z_size, y_size, x_size = self.shape
+        z_cen, y_cen, x_cen = [ s // 2 for s in self.shape ]
+
+        # Values are truncated to integers like assigning into
+        # a MapView's coordinate matrix would
+        self.center = array(pos).astype(int) + array((x_size-1-x_cen, y_size-1-y_cen, z_cen))
+        self.rotation = identity(3, dtype=int)
+        self._view = None
+
+    def apply_transformation(self, Tmatrix):
+        """Apply a transformation matrix to the pose. Only translations
+        and rotations by multiples of 90 deg can be represented."""
+
+        if Tmatrix.shape != (4, 4):
+            raise Exception("Tmatrix must be of shape (4, 4), not: %s" % (Tmatrix.shape,))
+
+        profiling.count("transforms")
+
+        Rmatrix = round(Tmatrix[:3, :3]).astype(int)
+        if abs(Tmatrix[:3, :3] - Rmatrix).max() > 1e-6:
+            raise ValueError("PoseMapView only supports rotations by multiples of 90 deg")
+
+        self.center = dot(Rmatrix, self.center) + round(Tmatrix[:3, 3]).astype(int)
+        self.rotation = dot(Rmatrix, self.rotation)
+        self._view = None
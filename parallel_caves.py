@@ -0,0 +1,180 @@
+import logging
+
+from multiprocessing import Pool
+from math import degrees
+from numpy import array, concatenate, unique, zeros
+
+from block_io import read_blocks, write_blocks, last_unique
+from caving import make_cave, random_start
+from edit_log import EditLog
+from map_view import MapView
+from pocket_mmap import WorldBounds
+from rng import make_rng
+from utils import load_world
+
+logger = logging.getLogger(__name__)
+
+# Tunnels starting within the same square of this many chunks
+# on a side are carved together by the same worker, and can not
+# carve past the edges of the square
+REGION_CHUNKS = 8
+
+# Copy of the world each worker process loads once and carves every
+# region it is handed into
+_worker_world = None
+
+class RegionWorld(object):
+    """A world seen through the bounds of one region, so that caves
+    carved in it stop at the edge of the region like they would at the
+    edge of the world. Any attribute not handled here is passed through
+    to the world."""
+
+    def __init__(self, world, region, region_chunks=REGION_CHUNKS):
+        self.world = world
+
+        bb = world.getWorldBounds()
+        size = region_chunks * 16
+        self.bounds = WorldBounds(max(bb.minx, region[0] * size), bb.miny, max(bb.minz, region[1] * size),
+                                  min(bb.maxx, (region[0] + 1) * size), bb.maxy, min(bb.maxz, (region[1] + 1) * size))
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the region itself
+        return getattr(self.world, name)
+
+    def getWorldBounds(self):
+        return self.bounds
+
+def start_region(start_pos, region_chunks=REGION_CHUNKS):
+    """Returns the region a tunnel starting at an x, y, z position is in"""
+
+    return ((start_pos[0] >> 4) // region_chunks, (start_pos[2] >> 4) // region_chunks)
+
+def plan_tunnels(world, patterns, region_chunks=REGION_CHUNKS, ground_index=None, rng=None):
+    """Pick a random start point and random seed for a tunnel of each
+    of the given patterns, using a GroundLevelIndex for start points
+    when one is given. Tunnels are grouped by the region of the
+    world they start in. Returns a list of (region, tunnels) tuples
+    sorted by region, tunnels being a list of (index, pattern,
+    start_pos, start_yaw, seed) tuples where index is the tunnel's
+    position in the pattern list."""
+
+    rng = make_rng(rng)
+
+    regions = {}
+    for index, pattern in enumerate(patterns):
+        start_pos, start_yaw = random_start(world, ground_index, rng=rng)
+        seed = rng.spawn_seed()
+
+        region = start_region(start_pos, region_chunks)
+        regions.setdefault(region, []).append((index, pattern, start_pos, start_yaw, seed))
+
+    return sorted(regions.items())
+
+def init_worker(world_file, loader, prior_records):
+    """Pool initializer loading the private copy of the world a worker
+    process carves into from a file, the copy is never saved. Edit log
+    records of changes made to the world before the workers started,
+    such as a tunnel at the player, are replayed onto the copy."""
+
+    global _worker_world
+    _worker_world = loader(world_file)
+
+    if prior_records is not None and len(prior_records):
+        prior_edits = EditLog()
+        prior_edits.batches.append(prior_records)
+        prior_edits.replay(_worker_world)
+
+def carve_region(args):
+    """Carve the tunnels of one region, one after another, into the
+    worker's copy of the world. Tunnels stop at the edges of the region,
+    so those of different regions never touch the same blocks and the
+    regions a worker carved before do not change what this one carves.
+    Returns a list of (index, region, records) tuples with the edit log
+    records of each tunnel."""
+
+    region, tunnels, region_chunks, view_class, cave_options = args
+    world = RegionWorld(_worker_world, region, region_chunks)
+
+    results = []
+    for index, pattern, start_pos, start_yaw, seed in tunnels:
+        logger.info("Carving tunnel #%d at: %s %f deg" % (index+1, start_pos, degrees(start_yaw)))
+
+        # Each tunnel gets its own seed so the result does not depend
+        # on which worker carves it
+        edit_log = EditLog()
+        cave_view = view_class(world, pattern.shape, start_pos, yaw=start_yaw)
+        make_cave(cave_view, pattern, edit_log=edit_log, rng=make_rng(seed), **cave_options)
+        results.append((index, region, edit_log.records()))
+
+    return results
+
+def merge_edits(world, results, edit_log=None):
+    """Apply the edits carved by workers to the world. Within a region
+    tunnels were carved one after another, so a block changed by several
+    of them ends up as the last one left it. Raises ValueError if blocks
+    were changed in more than one region, which can not happen unless
+    the tunnels were carved past their region. Returns an edit log of
+    the changes made."""
+
+    if edit_log is None:
+        edit_log = EditLog()
+
+    results = sorted(results, key=lambda result: result[0])
+    batches = [ records for index, region, records in results ]
+    if not batches:
+        return edit_log
+
+    records = concatenate(batches)
+
+    coords = array([records["x"], records["y"], records["z"]]).T
+    new_ids = records["new_id"]
+
+    # Blocks are only ever changed by the tunnels of a single region
+    regions = sorted(set([ region for index, region, batch in results ]))
+    record_regions = concatenate([ zeros(len(batch), dtype=int) + regions.index(region)
+                                   for index, region, batch in results ])
+    touched = unique(concatenate([ coords, record_regions[:, None] ], axis=1), axis=0)
+    if len(unique(touched[:, :3], axis=0)) != len(touched):
+        raise ValueError("Tunnels carved in different regions changed the same blocks")
+
+    last_edits = last_unique(coords)
+    coords = coords[last_edits]
+    new_ids = new_ids[last_edits]
+
+    old_data = read_blocks(world, coords)
+    new_data = write_blocks(world, coords, new_ids)
+    edit_log.record(coords, old_data, new_data)
+
+    return edit_log
+
+def parallel_tunnels(world, world_file, patterns, processes=None, loader=load_world,
+                     ground_index=None, edit_log=None, rng=None, view_class=MapView, **cave_options):
+    """Carve a tunnel for each of the given patterns using a pool of
+    worker processes. Tunnels starting in different regions of the world
+    are carved at the same time, each worker loading the world once from
+    world_file with the loader function and carving the tunnels of a
+    region only inside of the region they start in. The carved blocks
+    are merged back into world. Changes already made to world must all
+    be in edit_log, they are replayed onto the workers' copies before
+    carving. Start points and the seed of each tunnel are drawn from
+    rng, a seed or generator, or numpy's global random state by default.
+    Tunnels are carved with views of view_class. Remaining keyword
+    arguments are passed to make_cave. Returns an edit log of the changes
+    made to world."""
+
+    regions = plan_tunnels(world, patterns, ground_index=ground_index, rng=rng)
+    logger.info("Carving %d tunnels in %d regions" % (len(patterns), len(regions)))
+
+    # Workers start from the world as it is now, not as it was saved
+    prior_records = edit_log.records() if edit_log is not None else None
+
+    pool = Pool(processes, initializer=init_worker, initargs=(world_file, loader, prior_records))
+    try:
+        region_results = pool.map(carve_region, [ (region, tunnels, REGION_CHUNKS, view_class, cave_options)
+                                                  for region, tunnels in regions ])
+    finally:
+        pool.close()
+        pool.join()
+
+    results = [ result for region in region_results for result in region ]
+    return merge_edits(world, results, edit_log)
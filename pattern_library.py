@@ -0,0 +1,168 @@
+import os
+import hashlib
+import logging
+
+from numpy import asarray, array, load, savez, int16
+
+from patterns import CompiledPattern
+
+logger = logging.getLogger(__name__)
+
+# Files a library directory is searched for
+PATTERN_EXTENSIONS = (".npy", ".txt")
+
+# Changing how patterns are compiled must change this so that patterns
+# cached by an earlier version are compiled again
+CACHE_VERSION = 1
+
+def parse_pattern_text(text, name="pattern"):
+    """Returns the pattern written in a text grid. Like the patterns in
+    caving.py each layer along z is a grid whose rows go from the top
+    down, with layers separated by a blank line. Cells are block IDs
+    separated by whitespace or commas, with -1 or . to keep the existing
+    block. Anything after a # on a line is ignored."""
+
+    layers = [[]]
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].replace(",", " ").strip()
+        if not line:
+            if layers[-1]:
+                layers.append([])
+            continue
+        layers[-1].append([ -1 if cell == "." else int(cell) for cell in line.split() ])
+
+    if not layers[-1]:
+        layers.pop()
+    if not layers:
+        raise ValueError("Pattern %s is empty" % name)
+
+    for layer in layers:
+        if len(layer) != len(layers[0]) or any([ len(row) != len(layers[0][0]) for row in layer ]):
+            raise ValueError("Pattern %s does not have the same number of rows and columns in every layer" % name)
+
+    return array(layers)
+
+def validate_pattern(pattern, name="pattern"):
+    """Returns a pattern as an integer array after checking that it can be
+    carved, raising ValueError when it can not"""
+
+    pattern = asarray(pattern)
+    if pattern.ndim != 3:
+        raise ValueError("Pattern %s has %d dimensions instead of 3" % (name, pattern.ndim))
+    if pattern.dtype.kind not in "iu":
+        raise ValueError("Pattern %s has %s values instead of block IDs" % (name, pattern.dtype))
+
+    # Rotating around the center block needs one
+    if any([ size % 2 == 0 for size in pattern.shape ]):
+        raise ValueError("Pattern %s is shaped %s, every size must be odd" % (name, pattern.shape))
+
+    if pattern.size and (pattern.min() < -1 or pattern.max() > 255):
+        raise ValueError("Pattern %s has values outside of -1 to 255" % name)
+    if not (pattern > -1).any():
+        raise ValueError("Pattern %s does not set any blocks" % name)
+
+    return pattern.astype(int)
+
+def load_pattern(filename):
+    """Load and validate a pattern from a .npy file or a text grid"""
+
+    if filename.lower().endswith(".npy"):
+        pattern = load(filename)
+    else:
+        with open(filename) as pattern_file:
+            pattern = parse_pattern_text(pattern_file.read(), filename)
+
+    return validate_pattern(pattern, filename)
+
+def pattern_digest(pattern):
+    """Returns a hex digest of a pattern's shape and values"""
+
+    pattern = asarray(pattern)
+    digest = hashlib.sha1(("%d %s" % (CACHE_VERSION, pattern.shape)).encode("ascii"))
+    digest.update(pattern.astype(int16).tobytes())
+    return digest.hexdigest()
+
+class PatternLibrary(object):
+    """Named patterns loaded from files, each validated and compiled
+    once. With a cache directory the offsets of compiled patterns are
+    kept on disk keyed by the digest of the pattern, so later runs load
+    them instead of compiling the pattern again."""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.patterns = {}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, name):
+        return name in self.patterns
+
+    def __getitem__(self, name):
+        try:
+            return self.patterns[name]
+        except KeyError:
+            raise KeyError("No pattern named %s, the library has: %s" % (name, ", ".join(self.names())))
+
+    def names(self):
+        return sorted(self.patterns)
+
+    def add(self, name, pattern):
+        """Add a pattern array under a name, returns its CompiledPattern"""
+
+        pattern = validate_pattern(pattern, name)
+        self.patterns[name] = self.compile(pattern)
+        return self.patterns[name]
+
+    def load(self, path):
+        """Add the pattern of a file, or of every pattern file in a
+        directory, named after the file without its extension. Returns
+        the names added."""
+
+        if os.path.isdir(path):
+            filenames = [ os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                          if filename.lower().endswith(PATTERN_EXTENSIONS) ]
+        else:
+            filenames = [ path ]
+
+        names = []
+        for filename in filenames:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            self.patterns[name] = self.compile(load_pattern(filename))
+            names.append(name)
+
+        logger.info("Loaded %d patterns from %s" % (len(names), path))
+        return names
+
+    def cache_file(self, pattern):
+        return os.path.join(self.cache_dir, pattern_digest(pattern) + ".npz")
+
+    def compile(self, pattern):
+        """Returns the CompiledPattern of a validated pattern, from the
+        cache directory when it was compiled before"""
+
+        if self.cache_dir is None:
+            return CompiledPattern(pattern)
+
+        cache_file = self.cache_file(pattern)
+        if os.path.exists(cache_file):
+            try:
+                with load(cache_file) as cached:
+                    offsets = cached["offsets"]
+                if offsets.shape == (4, (pattern > -1).sum(), 3):
+                    return CompiledPattern(pattern, quarter_turn_offsets=offsets)
+                logger.warning("Ignoring cached pattern %s which does not match its pattern" % cache_file)
+            except (IOError, OSError, ValueError, KeyError) as error:
+                logger.warning("Ignoring unreadable cached pattern %s: %s" % (cache_file, error))
+
+        compiled = CompiledPattern(pattern)
+
+        # Failing to cache only costs compiling the pattern again next time
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            savez(cache_file, offsets=compiled.quarter_turn_offsets())
+        except (IOError, OSError) as error:
+            logger.warning("Could not cache compiled pattern in %s: %s" % (self.cache_dir, error))
+
+        return compiled
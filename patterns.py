@@ -0,0 +1,77 @@
+from math import radians
+from numpy import asarray, where, round, stack
+
+from map_view import MapView, PoseMapView
+
+class CompiledPattern(object):
+    """A caving pattern reduced to the cells that actually get set, those
+    not marked -1. Keeps the values of those cells and, for each
+    orientation of a PoseMapView, their offsets from the view's center
+    block, so that stamping the pattern only touches the blocks it
+    changes. Offsets for the four yaw orientations are computed up front,
+    unless they are given as returned by quarter_turn_offsets, and any
+    other orientation the first time it is used."""
+
+    def __init__(self, pattern, quarter_turn_offsets=None):
+        self.pattern = asarray(pattern)
+        self.shape = self.pattern.shape
+
+        # Mark which points we will actually set within the pattern
+        self.where_set = where(self.pattern > -1)
+        self.values = self.pattern[self.where_set]
+
+        self._offsets = {}
+        for quarter_turns, rotation in enumerate(self.quarter_turn_rotations()):
+            if quarter_turn_offsets is None:
+                self.offsets(rotation)
+            else:
+                offsets = asarray(quarter_turn_offsets[quarter_turns])
+                offsets.setflags(write=False)
+                self._offsets[rotation.tobytes()] = offsets
+
+    @staticmethod
+    def quarter_turn_rotations():
+        """Returns the 3x3 integer rotation matrices of the four yaw
+        orientations"""
+
+        return [ round(MapView.rotation_matrix_y(radians(quarter_turns * 90))[:3, :3]).astype(int)
+                 for quarter_turns in range(4) ]
+
+    def __len__(self):
+        return len(self.values)
+
+    def offsets(self, rotation):
+        """Returns the offsets of the set cells from the center block of a
+        view with the given 3x3 integer rotation matrix, shaped (N, 3)"""
+
+        key = rotation.tobytes()
+        offsets = self._offsets.get(key)
+        if offsets is None:
+            offsets = PoseMapView.pose_offsets(self.shape, rotation)[self.where_set]
+            offsets.setflags(write=False)
+            self._offsets[key] = offsets
+        return offsets
+
+    def quarter_turn_offsets(self):
+        """Returns the offsets for the four yaw orientations shaped (4, N, 3)"""
+
+        return stack([ self.offsets(rotation) for rotation in self.quarter_turn_rotations() ])
+
+# Compiled patterns keyed by shape and content
+_compiled = {}
+
+def compile_pattern(pattern):
+    """Returns the CompiledPattern for a pattern array, reusing the one
+    made before for the same pattern. Compiled patterns are returned
+    as they are."""
+
+    if isinstance(pattern, CompiledPattern):
+        return pattern
+
+    pattern = asarray(pattern)
+    key = (pattern.shape, pattern.tobytes())
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = CompiledPattern(pattern)
+        _compiled[key] = compiled
+    return compiled
@@ -0,0 +1,244 @@
+import os
+import mmap
+import logging
+
+from collections import namedtuple
+from numpy import frombuffer, zeros, uint8
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Layout of a Pocket Edition chunks.dat file. The first sector holds the
+# location of each of the 32 x 32 chunks as a little endian integer whose
+# lowest byte is the number of sectors used and the rest the first sector.
+SECTOR_BYTES = 4096
+CHUNKS_PER_SIDE = 32
+CHUNK_HEADER_BYTES = 4
+
+# Chunk data is the block IDs followed by block data, sky light and block
+# light packed two values to a byte and a map of modified columns
+CHUNK_HEIGHT = 128
+BLOCKS_BYTES = 16 * 16 * CHUNK_HEIGHT
+NIBBLES_BYTES = BLOCKS_BYTES // 2
+DIRTY_COLUMNS_BYTES = 16 * 16
+CHUNK_DATA_BYTES = BLOCKS_BYTES + 3 * NIBBLES_BYTES + DIRTY_COLUMNS_BYTES
+
+# Chunk arrays stored as nibbles in the order they are stored
+NIBBLE_ARRAYS = ("Data", "SkyLight", "BlockLight")
+
+WorldBounds = namedtuple("WorldBounds", "minx miny minz maxx maxy maxz")
+
+class ChunkNotPresent(KeyError):
+    pass
+
+def read_chunk_index(header, file_size):
+    """Returns the first sector and number of sectors of every chunk
+    from the first sector of a chunks.dat file of the given size in
+    bytes, along with the set of cx, cz positions of the chunks whose
+    sectors fit inside the file"""
+
+    offsets = frombuffer(header, dtype="<u4", count=CHUNKS_PER_SIDE*CHUNKS_PER_SIDE).copy()
+    sectors = offsets >> 8
+    sector_counts = offsets & 0xff
+
+    file_sectors = file_size // SECTOR_BYTES
+    present = (sectors > 0) & (sector_counts > 0) & (sectors + sector_counts <= file_sectors)
+    chunk_positions = set([ (index % CHUNKS_PER_SIDE, index // CHUNKS_PER_SIDE) for index in present.nonzero()[0] ])
+
+    return sectors, sector_counts, chunk_positions
+
+def world_size(chunk_positions):
+    """Returns the width and length in blocks of a world reaching out
+    to the furthest of its chunk positions"""
+
+    if not chunk_positions:
+        return 0, 0
+
+    width = (int(max([ cx for cx, cz in chunk_positions ])) + 1) * 16
+    length = (int(max([ cz for cx, cz in chunk_positions ])) + 1) * 16
+    return width, length
+
+def read_world_size(filename):
+    """Returns the width and length in blocks of a world given either
+    its path or the path of chunks.dat, reading only the chunk index"""
+
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "chunks.dat")
+
+    with open(filename, "rb") as chunks_file:
+        header = chunks_file.read(SECTOR_BYTES)
+
+    header = header + b"\0" * (SECTOR_BYTES - len(header))
+    return world_size(read_chunk_index(header, os.path.getsize(filename))[2])
+
+def unpack_nibbles(packed):
+    """Returns a 16 x 16 x CHUNK_HEIGHT array from values packed two to a
+    byte, with the lower nibble holding the even y value"""
+
+    packed = packed.reshape(16, 16, CHUNK_HEIGHT // 2)
+    unpacked = zeros((16, 16, CHUNK_HEIGHT), dtype=uint8)
+    unpacked[:, :, ::2] = packed & 0xf
+    unpacked[:, :, 1::2] = packed >> 4
+    return unpacked
+
+def pack_nibbles(unpacked):
+    """Returns the bytes of a 16 x 16 x CHUNK_HEIGHT array packed two
+    values to a byte, the reverse of unpack_nibbles"""
+
+    packed = (unpacked[:, :, ::2] & 0xf) | ((unpacked[:, :, 1::2] & 0xf) << 4)
+    return packed.astype(uint8).tobytes()
+
+class MappedChunk(object):
+    """Chunk of a MappedPocketWorld with the same block arrays, indexed by
+    x, z and y, that pymclevel's Pocket chunks have"""
+
+    def __init__(self, world, chunk_pos, data):
+        self.world = world
+        self.chunkPosition = chunk_pos
+
+        self.Blocks = data[:BLOCKS_BYTES].reshape(16, 16, CHUNK_HEIGHT).copy()
+        for index, name in enumerate(NIBBLE_ARRAYS):
+            begin = BLOCKS_BYTES + index * NIBBLES_BYTES
+            setattr(self, name, unpack_nibbles(data[begin:begin+NIBBLES_BYTES]))
+        self.DirtyColumns = data[CHUNK_DATA_BYTES-DIRTY_COLUMNS_BYTES:CHUNK_DATA_BYTES].copy()
+
+        self.dirty = False
+        self.needsLighting = False
+
+    def chunkChanged(self, calcLighting=True):
+        self.dirty = True
+        self.needsLighting = calcLighting or self.needsLighting
+
+    def savedData(self):
+        """Returns the chunk encoded the way chunks.dat stores it"""
+
+        # Every bit of a column's entry marks 16 blocks of the column as
+        # modified, we only know that something in the chunk changed
+        self.DirtyColumns[:] = 255
+
+        return b"".join([ self.Blocks.astype(uint8).tobytes() ] +
+                        [ pack_nibbles(getattr(self, name)) for name in NIBBLE_ARRAYS ] +
+                        [ self.DirtyColumns.tobytes() ])
+
+class MappedPocketWorld(object):
+    """Pocket Edition world read straight from a memory mapped chunks.dat
+    file, usable in place of pymclevel's PocketWorld. Only the sector
+    index is read when opening the world, chunks are decoded the first
+    time they are used and saving writes back just the sectors of the
+    chunks that were modified. A read only world can still be modified
+    in memory but can not be saved."""
+
+    Height = CHUNK_HEIGHT
+
+    def __init__(self, filename, readonly=False):
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, "chunks.dat")
+        self.filename = filename
+        self.readonly = readonly
+
+        self.file = open(filename, "rb" if readonly else "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+        self.sectors, self.sector_counts, self.chunk_positions = read_chunk_index(self.map[:SECTOR_BYTES], len(self.map))
+
+        # Size the world to the chunks it contains
+        self.Width, self.Length = world_size(self.chunk_positions)
+
+        # Named like pymclevel's so a ChunkCache can release decoded chunks
+        self._loadedChunks = {}
+
+    @property
+    def materials(self):
+        from pymclevel.materials import pocketMaterials
+        return pocketMaterials
+
+    @property
+    def allChunks(self):
+        return sorted(self.chunk_positions)
+
+    def getWorldBounds(self):
+        return WorldBounds(0, 0, 0, self.Width, self.Height, self.Length)
+
+    def containsChunk(self, cx, cz):
+        return (cx, cz) in self.chunk_positions
+
+    def chunk_offset(self, cx, cz):
+        """Returns the byte offset in the file of a chunk's data"""
+
+        return int(self.sectors[cx + cz * CHUNKS_PER_SIDE]) * SECTOR_BYTES + CHUNK_HEADER_BYTES
+
+    def getChunk(self, cx, cz):
+        """Returns a chunk, decoding it from the file when first used"""
+
+        chunk = self._loadedChunks.get((cx, cz))
+        if chunk is None:
+            if not self.containsChunk(cx, cz):
+                raise ChunkNotPresent((cx, cz))
+
+            data = frombuffer(self.map, dtype=uint8, count=CHUNK_DATA_BYTES, offset=self.chunk_offset(cx, cz))
+            chunk = MappedChunk(self, (cx, cz), data)
+            profiling.count("chunks_decoded")
+            self._loadedChunks[cx, cz] = chunk
+        return chunk
+
+    def blockAt(self, x, y, z):
+        profiling.count("blockAt")
+        if y < 0 or y >= self.Height or not self.containsChunk(x >> 4, z >> 4):
+            return 0
+        return self.getChunk(x >> 4, z >> 4).Blocks[x & 0xf, z & 0xf, y]
+
+    def setBlockAt(self, x, y, z, blockID):
+        profiling.count("setBlockAt")
+        if y < 0 or y >= self.Height or not self.containsChunk(x >> 4, z >> 4):
+            return
+        chunk = self.getChunk(x >> 4, z >> 4)
+        chunk.Blocks[x & 0xf, z & 0xf, y] = blockID
+        chunk.chunkChanged()
+
+    def dirty_chunks(self):
+        """Returns the loaded chunks that were modified"""
+
+        return [ chunk for pos, chunk in sorted(self._loadedChunks.items()) if chunk.dirty ]
+
+    def generateLights(self, dirtyChunks=None):
+        """Relight the chunks at the cx, cz chunk positions in dirtyChunks
+        like pymclevel does, by default those modified since they were
+        last lit"""
+
+        from lighting import relight_chunks
+
+        if dirtyChunks is None:
+            dirtyChunks = [ chunk.chunkPosition for chunk in self.dirty_chunks() if chunk.needsLighting ]
+        dirtyChunks = [ tuple(chunk_pos) for chunk_pos in dirtyChunks if self.containsChunk(*chunk_pos) ]
+
+        relight_chunks(self, dirtyChunks)
+        for chunk_pos in dirtyChunks:
+            self.getChunk(*chunk_pos).needsLighting = False
+
+    def saveInPlace(self):
+        """Write the modified chunks back into their sectors of the file"""
+
+        if self.readonly:
+            raise IOError("World %s was opened read only" % self.filename)
+
+        saved = 0
+        for chunk in self.dirty_chunks():
+            offset = self.chunk_offset(*chunk.chunkPosition)
+            self.map[offset:offset+CHUNK_DATA_BYTES] = chunk.savedData()
+            chunk.dirty = False
+            saved += 1
+        profiling.count("chunks_saved", saved)
+
+        self.map.flush()
+        logger.info("Saved %d chunks to %s" % (saved, self.filename))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def load_readonly(filename):
+    """Map a world that will never be saved, such as the private copy
+    of a parallel_tunnels worker"""
+
+    return MappedPocketWorld(filename, readonly=True)
@@ -0,0 +1,122 @@
+import zlib
+import struct
+import logging
+
+from numpy import asarray, zeros, full, maximum, argmax, where, uint8, save
+
+from block_io import last_unique
+
+logger = logging.getLogger(__name__)
+
+# Colors of the carved blocks seen from above, when several end up in
+# the same column the one listed first is shown
+TUNNEL_COLORS = (
+    ((10, 11), (255, 120, 0)),  # Lava
+    ((8, 9), (40, 90, 255)),    # Water
+    ((0,), (230, 30, 30)),      # Air of a tunnel
+    )
+
+# Color of any other block a cave put down, such as a tunnel floor
+OTHER_COLOR = (200, 180, 120)
+
+def heightmap(world):
+    """Returns the y of the highest non air block of every x, z column
+    of a world indexed by z and x like a map seen from above, -1 for
+    columns without any blocks"""
+
+    bb = world.getWorldBounds()
+    x_size, z_size = bb.maxx - bb.minx, bb.maxz - bb.minz
+    heights = full((z_size, x_size), -1, dtype=int)
+
+    for cx, cz in world.allChunks:
+        x_beg = cx * 16 - bb.minx
+        z_beg = cz * 16 - bb.minz
+        if x_beg < 0 or z_beg < 0 or x_beg >= x_size or z_beg >= z_size:
+            continue
+
+        # The highest non air block is the first one from the top
+        solid = world.getChunk(cx, cz).Blocks[:, :, ::-1] != 0
+        top = where(solid.any(axis=2), solid.shape[2] - 1 - argmax(solid, axis=2), -1)
+
+        x_end = min(x_beg + 16, x_size)
+        z_end = min(z_beg + 16, z_size)
+        heights[z_beg:z_end, x_beg:x_end] = top[:x_end-x_beg, :z_end-z_beg].T
+
+    return heights
+
+def render_preview(heights, edit_log, height=128, origin=(0, 0)):
+    """Returns an RGB image shaped like heights, as returned by heightmap,
+    with the terrain shaded by its height and every column an edit of
+    the log changed colored by the blocks it was given. Origin is the x, z
+    position of the first column of heights."""
+
+    heights = asarray(heights)
+    z_size, x_size = heights.shape
+
+    # Brighter the higher the ground is
+    shade = (40 + 200 * maximum(heights, 0) / float(height)).astype(uint8)
+    image = zeros((z_size, x_size, 3), dtype=uint8)
+    image[...] = shade[..., None]
+    image[heights < 0] = 0
+
+    # Only the block each position ended up as is shown
+    records = edit_log.records()
+    coords = edit_log.coords()
+    if len(records) == 0:
+        return image
+    final = last_unique(coords)
+    x = coords[final, 0] - origin[0]
+    z = coords[final, 2] - origin[1]
+    new_ids = records["new_id"][final]
+
+    inside = (x >= 0) & (x < x_size) & (z >= 0) & (z < z_size)
+    x, z, new_ids = x[inside], z[inside], new_ids[inside]
+
+    # Rank the blocks so the color listed first wins in each column
+    ranks = full(256, 1, dtype=int)
+    colors = zeros((len(TUNNEL_COLORS) + 2, 3), dtype=uint8)
+    colors[1] = OTHER_COLOR
+    for index, (block_ids, color) in enumerate(TUNNEL_COLORS):
+        rank = len(TUNNEL_COLORS) + 1 - index
+        ranks[list(block_ids)] = rank
+        colors[rank] = color
+
+    column_ranks = zeros((z_size, x_size), dtype=int)
+    maximum.at(column_ranks, (z, x), ranks[new_ids])
+
+    carved = column_ranks > 0
+    image[carved] = colors[column_ranks[carved]]
+
+    return image
+
+def png_bytes(image):
+    """Returns an RGB image shaped (rows, columns, 3) encoded as a PNG"""
+
+    image = asarray(image, dtype=uint8)
+    rows, columns = image.shape[:2]
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    # Every row starts with filter type 0, no filtering
+    raw = zeros((rows, columns * 3 + 1), dtype=uint8)
+    raw[:, 1:] = image.reshape(rows, columns * 3)
+
+    return b"".join([ b"\x89PNG\r\n\x1a\n",
+                      chunk(b"IHDR", struct.pack(">IIBBBBB", columns, rows, 8, 2, 0, 0, 0)),
+                      chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)),
+                      chunk(b"IEND", b""),
+                      ])
+
+def save_preview(filename, image):
+    """Write a preview image as a NumPy array when filename ends in .npy
+    and as a PNG otherwise"""
+
+    if filename.lower().endswith(".npy"):
+        save(filename, image)
+    else:
+        with open(filename, "wb") as png_file:
+            png_file.write(png_bytes(image))
+
+    logger.info("Wrote %d x %d preview to %s" % (image.shape[1], image.shape[0], filename))
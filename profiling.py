@@ -0,0 +1,52 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Profiler(object):
+    """Counters and timers for the hot paths of the caving code. Timers
+    add up seconds measured by the caller, such as the phases timed by
+    make_caves. While disabled, which is the default, counting and
+    timing return right away so the instrumentation can stay in place."""
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.times = {}
+        self.calls = {}
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def report(self):
+        """Returns a dictionary of all counters and timers"""
+
+        return { "counters": dict(self.counters),
+                 "timers": dict([ (name, { "seconds": seconds, "calls": self.calls[name] })
+                                  for name, seconds in self.times.items() ]),
+                 }
+
+    def dump(self, filename):
+        """Write the report as JSON"""
+
+        with open(filename, "w") as out:
+            json.dump(self.report(), out, indent=2, sort_keys=True)
+        logger.info("Wrote profile to %s" % filename)
+
+# Shared by all instrumented code
+profiler = Profiler()
+
+count = profiler.count
+add_time = profiler.add_time
+
+def enable(enabled=True):
+    profiler.enabled = enabled
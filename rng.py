@@ -0,0 +1,54 @@
+from numpy import random
+
+class CaveRandom(object):
+    """Gives the caving code one set of random draws whether it is backed
+    by numpy's global random state, a RandomState or a Generator.
+    Draws from the global state or a RandomState are the same ones the
+    caving code always made, so a given seed carves the same caves."""
+
+    def __init__(self, source=random):
+        self.source = source
+
+        # Generators name their draws differently than RandomState
+        # and the numpy.random module functions
+        self.is_generator = hasattr(source, "integers")
+
+    def sample(self):
+        """Returns a float in [0, 1)"""
+
+        if self.is_generator:
+            return self.source.random()
+        return self.source.random_sample()
+
+    def randint(self, low, high):
+        """Returns an integer in [low, high)"""
+
+        if self.is_generator:
+            return self.source.integers(low, high)
+        return self.source.randint(low, high)
+
+    def random_integers(self, low, high):
+        """Returns an integer in [low, high]"""
+
+        return self.randint(low, high + 1)
+
+    def binomial(self, n, p):
+        return self.source.binomial(n, p)
+
+    def spawn_seed(self):
+        """Returns a seed for a new independent CaveRandom"""
+
+        return int(self.randint(0, 2**31 - 1))
+
+def make_rng(seed=None):
+    """Returns a CaveRandom given a seed or source of random numbers. With
+    no seed numpy's global random state is used, an integer seeds a new
+    RandomState and a RandomState, Generator or CaveRandom is used as is."""
+
+    if seed is None:
+        return CaveRandom(random)
+    if isinstance(seed, CaveRandom):
+        return seed
+    if hasattr(seed, "binomial"):
+        return CaveRandom(seed)
+    return CaveRandom(random.RandomState(seed))
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import json
+import shutil
+import struct
+import logging
+import platform
+import tempfile
+import resource
+import traceback
+from multiprocessing import Process, Pipe
+from optparse import OptionParser
+
+import numpy
+from numpy import zeros, polyfit, log, uint8
+
+from benchmark import SyntheticWorld, int_list
+from make_caves import carve_world
+from pocket_mmap import SECTOR_BYTES, CHUNKS_PER_SIDE, CHUNK_HEADER_BYTES, CHUNK_DATA_BYTES, \
+    DIRTY_COLUMNS_BYTES, NIBBLE_ARRAYS, pack_nibbles
+
+logger = logging.getLogger(__name__)
+
+# Phases of a run whose seconds should grow no faster than the number
+# of tunnels carved
+SCALING_PHASES = ("carve", "relight", "save", "total")
+
+# Phases whose seconds per changed block should not grow with the size
+# of the world, loading is left out as it reads the whole world
+EDIT_PHASES = ("carve", "relight", "save")
+
+def write_chunks_dat(filename, world):
+    """Write every chunk of a world, such as a SyntheticWorld, to a
+    Pocket Edition chunks.dat file. Chunks are stored one after another
+    after the sector index with all of their columns marked modified."""
+
+    chunk_bytes = CHUNK_HEADER_BYTES + CHUNK_DATA_BYTES
+    chunk_sectors = (chunk_bytes + SECTOR_BYTES - 1) // SECTOR_BYTES
+    index = zeros(CHUNKS_PER_SIDE * CHUNKS_PER_SIDE, dtype="<u4")
+
+    with open(filename, "wb") as chunks_file:
+        chunks_file.write(b"\0" * SECTOR_BYTES)
+
+        sector = 1
+        for cx, cz in sorted(world.allChunks):
+            if not (0 <= cx < CHUNKS_PER_SIDE and 0 <= cz < CHUNKS_PER_SIDE):
+                raise ValueError("Chunk %s does not fit in a chunks.dat file" % ((cx, cz),))
+
+            chunk = world.getChunk(cx, cz)
+            data = b"".join([ struct.pack("<I", chunk_bytes), chunk.Blocks.astype(uint8).tobytes() ] +
+                            [ pack_nibbles(getattr(chunk, name)) for name in NIBBLE_ARRAYS ] +
+                            [ b"\xff" * DIRTY_COLUMNS_BYTES ])
+            chunks_file.write(data + b"\0" * (chunk_sectors * SECTOR_BYTES - len(data)))
+
+            index[cx + cz * CHUNKS_PER_SIDE] = (sector << 8) | chunk_sectors
+            sector += chunk_sectors
+
+        chunks_file.seek(0)
+        chunks_file.write(index.tobytes())
+
+def nbt_string(value):
+    value = value.encode("utf-8")
+    return struct.pack("<H", len(value)) + value
+
+def nbt_float_list(name, values):
+    return b"\x09" + nbt_string(name) + struct.pack("<bi", 5, len(values)) + struct.pack("<%df" % len(values), *values)
+
+def write_level_dat(filename, player_pos, player_yaw=0.0, level_name="scaling benchmark"):
+    """Write a Pocket Edition level.dat holding just the player's position
+    and rotation: uncompressed little endian NBT after a header of the
+    storage version and the length of the NBT data"""
+
+    player = b"\x0a" + nbt_string("Player") + \
+             nbt_float_list("Pos", [ float(value) for value in player_pos ]) + \
+             nbt_float_list("Rotation", [ float(player_yaw), 0.0 ]) + \
+             b"\x00"
+    root = b"\x0a" + nbt_string("") + \
+           b"\x08" + nbt_string("LevelName") + nbt_string(level_name) + \
+           player + \
+           b"\x00"
+
+    with open(filename, "wb") as level_file:
+        level_file.write(struct.pack("<ii", 2, len(root)))
+        level_file.write(root)
+
+def build_world(directory, chunks_side, seed=0):
+    """Write a synthetic world of chunks_side by chunks_side chunks to a
+    directory, with the player standing on the ground in its middle"""
+
+    world = SyntheticWorld(chunks_side, seed)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    write_chunks_dat(os.path.join(directory, "chunks.dat"), world)
+
+    middle = chunks_side * 16 // 2
+    write_level_dat(os.path.join(directory, "level.dat"), (middle, world.heights[middle, middle] + 2, middle))
+
+def peak_rss_bytes():
+    """Returns the most memory this process has used so far"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, Mac OS X bytes
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+def carve_case(connection, w_file, options):
+    try:
+        result = carve_world(w_file, **options)
+        result["peak_rss_bytes"] = peak_rss_bytes()
+        connection.send(("ok", result))
+    except Exception:
+        connection.send(("failed", traceback.format_exc()))
+    connection.close()
+
+def run_case(template_dir, work_dir, options):
+    """Carve a copy of the world in template_dir with the carve_world
+    options in a process of its own, so that each run starts from a
+    freshly loaded world and its peak memory use is its own. Returns
+    the result of carve_world with the peak memory use added, raises
+    RuntimeError with the traceback of the run when it fails."""
+
+    w_file = os.path.join(work_dir, "world")
+    shutil.copytree(template_dir, w_file)
+
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=carve_case, args=(sender, w_file, options))
+    process.start()
+    sender.close()
+    try:
+        status, result = receiver.recv()
+    except EOFError:
+        status, result = "failed", "Carving process exited with code %s" % process.exitcode
+    process.join()
+    shutil.rmtree(w_file)
+
+    if status != "ok":
+        raise RuntimeError(result)
+    return result
+
+def run_scaling(sizes, tunnel_counts, work_dir, seed=0, num_lava_tubes=2, num_water_tubes=2, jobs=1, use_mmap=False):
+    """Run the whole make_caves pipeline, player tunnel, random tunnels,
+    lava and water tubes, lighting and saving, on a synthetic world of
+    each size in chunks per side with each number of random tunnels.
+    A run that fails is recorded with its error and the rest go on.
+    Returns a list of result dictionaries."""
+
+    results = []
+    for chunks_side in sizes:
+        template_dir = os.path.join(work_dir, "template_%d" % chunks_side)
+        logger.info("Building %d x %d chunk world" % (chunks_side, chunks_side))
+        build_world(template_dir, chunks_side, seed)
+
+        for num_tunnels in tunnel_counts:
+            options = { "tunnel_at_player": True,
+                        "num_random_tunnels": num_tunnels,
+                        "num_lava_tubes": num_lava_tubes,
+                        "num_water_tubes": num_water_tubes,
+                        "seed": seed,
+                        "jobs": jobs,
+                        "use_mmap": use_mmap,
+                        }
+            result = { "world_chunks": chunks_side,
+                       "tunnels": num_tunnels,
+                       "lava_tubes": num_lava_tubes,
+                       "water_tubes": num_water_tubes,
+                       "seed": seed,
+                       }
+            try:
+                run = run_case(template_dir, work_dir, options)
+            except Exception as error:
+                result["status"] = "failed"
+                result["error"] = str(error)
+                logger.error("%3d chunks %4d tunnels: failed\n%s" % (chunks_side, num_tunnels, error))
+                results.append(result)
+                continue
+
+            timings = run["timings"]
+            result.update({ "status": "ok",
+                       "changed_blocks": run["changed_blocks"],
+                       "timings": timings,
+                       "peak_rss_bytes": run["peak_rss_bytes"],
+                       "blocks_per_second": run["changed_blocks"] / timings["total"],
+                       "carved_blocks_per_second": run["changed_blocks"] / max(timings["carve"], 1e-9),
+                       })
+            logger.info("%3d chunks %4d tunnels: %d blocks in %.2f s, %.0f blocks/s, peak %.1f MB" %
+                        (chunks_side, num_tunnels, result["changed_blocks"], timings["total"],
+                         result["blocks_per_second"], result["peak_rss_bytes"] / 1e6))
+            results.append(result)
+
+        shutil.rmtree(template_dir)
+
+    return results
+
+def scaling_exponents(results, phases=SCALING_PHASES, min_seconds=0.05):
+    """Fit seconds = a * tunnels ** exponent through the runs of each
+    world size for every phase. Phases where any run took less than
+    min_seconds are too noisy to fit and left out. Fixed costs, like
+    the player tunnel and the tubes, pull exponents below 1. Returns a
+    dictionary of exponents by phase keyed by world size."""
+
+    results = [ result for result in results if result.get("status") == "ok" ]
+
+    exponents = {}
+    for chunks_side in sorted(set([ result["world_chunks"] for result in results ])):
+        runs = sorted([ result for result in results if result["world_chunks"] == chunks_side ],
+                      key=lambda result: result["tunnels"])
+        if len(set([ run["tunnels"] for run in runs ])) < 2 or runs[0]["tunnels"] < 1:
+            continue
+
+        fitted = {}
+        for phase in phases:
+            seconds = [ run["timings"].get(phase, 0.0) for run in runs ]
+            if min(seconds) < min_seconds:
+                continue
+            fitted[phase] = float(polyfit(log([ run["tunnels"] for run in runs ]), log(seconds), 1)[0])
+        exponents[chunks_side] = fitted
+
+    return exponents
+
+def world_size_exponents(results, phases=EDIT_PHASES, min_seconds=0.05):
+    """Fit seconds / changed blocks = a * world chunks ** exponent through
+    the runs carving each number of tunnels in worlds of every size, for
+    every phase. Carving, relighting and saving should cost the same per
+    changed block whatever the size of the world, so exponents should be
+    close to 0. Phases where any run took less than min_seconds are left
+    out. Returns a dictionary of exponents by phase keyed by number of
+    tunnels."""
+
+    results = [ result for result in results if result.get("status") == "ok" and result["changed_blocks"] > 0 ]
+
+    exponents = {}
+    for num_tunnels in sorted(set([ result["tunnels"] for result in results ])):
+        runs = sorted([ result for result in results if result["tunnels"] == num_tunnels ],
+                      key=lambda result: result["world_chunks"])
+        if len(set([ run["world_chunks"] for run in runs ])) < 2:
+            continue
+
+        fitted = {}
+        for phase in phases:
+            seconds = [ run["timings"].get(phase, 0.0) for run in runs ]
+            if min(seconds) < min_seconds:
+                continue
+            per_block = [ phase_seconds / run["changed_blocks"] for phase_seconds, run in zip(seconds, runs) ]
+            world_chunks = [ run["world_chunks"] ** 2 for run in runs ]
+            fitted[phase] = float(polyfit(log(world_chunks), log(per_block), 1)[0])
+        exponents[num_tunnels] = fitted
+
+    return exponents
+
+def find_regressions(results, exponents, tolerance=0.15, baseline=None, max_slowdown=0.2, world_exponents=None):
+    """Returns a list of messages for every run that failed, for every
+    phase that scales worse than linearly with the number of tunnels,
+    beyond tolerance, and with world_exponents, as returned by
+    world_size_exponents, for every phase whose seconds per changed block
+    grow with the size of the world by more than tolerance. With a
+    baseline list of results also for every run whose blocks per second
+    fell by more than max_slowdown compared to the same run in the
+    baseline."""
+
+    flags = []
+    for result in results:
+        if result.get("status") != "ok":
+            flags.append("%d chunk world, %d tunnels failed: %s" %
+                         (result["world_chunks"], result["tunnels"],
+                          (result.get("error", "").strip().splitlines() or [""])[-1]))
+
+    for chunks_side, fitted in sorted(exponents.items()):
+        for phase, exponent in sorted(fitted.items()):
+            if exponent > 1 + tolerance:
+                flags.append("%d chunk world: %s time grows as tunnels ** %.2f" % (chunks_side, phase, exponent))
+
+    for num_tunnels, fitted in sorted((world_exponents or {}).items()):
+        for phase, exponent in sorted(fitted.items()):
+            if exponent > tolerance:
+                flags.append("%d tunnels: %s seconds per changed block grow as world chunks ** %.2f" %
+                             (num_tunnels, phase, exponent))
+
+    if baseline is not None:
+        before = dict([ ((result["world_chunks"], result["tunnels"]), result) for result in baseline ])
+        for result in results:
+            previous = before.get((result["world_chunks"], result["tunnels"]))
+            if result.get("status") != "ok" or previous is None or previous.get("status", "ok") != "ok":
+                continue
+            if result["blocks_per_second"] < (1 - max_slowdown) * previous["blocks_per_second"]:
+                flags.append("%d chunk world, %d tunnels: %.0f blocks/s down from %.0f" %
+                             (result["world_chunks"], result["tunnels"],
+                              result["blocks_per_second"], previous["blocks_per_second"]))
+
+    return flags
+
+def standalone_main():
+    parser = OptionParser("[options]")
+
+    parser.add_option("-s", "--sizes",
+                      dest="sizes", default="8,16",
+                      help="Comma separated sizes of the synthetic worlds in chunks per side, at most 32")
+
+    parser.add_option("-t", "--tunnels",
+                      dest="tunnels", default="10,20,40",
+                      help="Comma separated numbers of random tunnels carved in each world")
+
+    parser.add_option("-l", "--num_lava_tubes",
+                      type="int",
+                      dest="num_lava_tubes", default=2,
+                      help="Number of lava tubes carved in every run")
+
+    parser.add_option("-w", "--num_water_tubes",
+                      type="int",
+                      dest="num_water_tubes", default=2,
+                      help="Number of water tubes carved in every run")
+
+    parser.add_option("--seed",
+                      type="int",
+                      dest="seed", default=0,
+                      help="Seed used to generate the worlds and carve them")
+
+    parser.add_option("-j", "--jobs",
+                      type="int",
+                      dest="jobs", default=1,
+                      help="Number of processes used to carve random tunnels, lava and water tubes")
+
+    parser.add_option("-m", "--mmap",
+                      action="store_true", dest="mmap", default=False,
+                      help="Memory map chunks.dat instead of loading worlds with pymclevel")
+
+    parser.add_option("--work_dir",
+                      dest="work_dir", default=None,
+                      help="Directory to write the worlds to, a temporary directory by default")
+
+    parser.add_option("--tolerance",
+                      type="float",
+                      dest="tolerance", default=0.15,
+                      help="How far above 1 the tunnel exponent, and above 0 the world size exponent, of a phase may be before it is flagged")
+
+    parser.add_option("--min_seconds",
+                      type="float",
+                      dest="min_seconds", default=0.05,
+                      help="Phases faster than this in any run are not checked for scaling")
+
+    parser.add_option("--baseline",
+                      dest="baseline", default=None,
+                      help="Results written earlier to compare blocks per second against")
+
+    parser.add_option("--max_slowdown",
+                      type="float",
+                      dest="max_slowdown", default=0.2,
+                      help="Fraction of the baseline's blocks per second a run may lose before it is flagged")
+
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="File to write JSON results to instead of standard output")
+
+    parser.add_option("--label",
+                      dest="label", default=None,
+                      help="Label stored with the results, such as the commit benchmarked")
+
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose", default=False,
+                      help="print the log messages of every run")
+
+    (options, args) = parser.parse_args()
+
+    # Only progress is shown unless asked for more
+    root_logger = logging.getLogger()
+    sh = logging.StreamHandler()
+    root_logger.addHandler(sh)
+    root_logger.setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    sizes = int_list(options.sizes)
+    if [ size for size in sizes if size < 1 or size > CHUNKS_PER_SIDE ]:
+        parser.error("World sizes must be between 1 and %d chunks" % CHUNKS_PER_SIDE)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="scaling_benchmark_")
+    try:
+        results = run_scaling(sizes, int_list(options.tunnels), work_dir,
+                              seed=options.seed,
+                              num_lava_tubes=options.num_lava_tubes,
+                              num_water_tubes=options.num_water_tubes,
+                              jobs=options.jobs,
+                              use_mmap=options.mmap)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    exponents = scaling_exponents(results, min_seconds=options.min_seconds)
+    world_exponents = world_size_exponents(results, min_seconds=options.min_seconds)
+    flags = find_regressions(results, exponents, tolerance=options.tolerance,
+                             baseline=baseline, max_slowdown=options.max_slowdown,
+                             world_exponents=world_exponents)
+
+    report = { "label": options.label,
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": numpy.__version__,
+               "platform": platform.platform(),
+               "results": results,
+               "scaling_exponents": dict([ (str(size), fitted) for size, fitted in exponents.items() ]),
+               "world_size_exponents": dict([ (str(num_tunnels), fitted) for num_tunnels, fitted in world_exponents.items() ]),
+               "flags": flags,
+               }
+
+    if options.output:
+        with open(options.output, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+        logger.info("Wrote %d results to %s" % (len(results), options.output))
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    for flag in flags:
+        logger.error("Scaling regression: %s" % flag)
+
+    root_logger.removeHandler(sh)
+
+    return 1 if flags else 0
+
+if __name__ == "__main__":
+    sys.exit(standalone_main())
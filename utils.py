@@ -4,29 +4,51 @@ import logging
 from math import radians, degrees
 from numpy import array, mod
 
-from pymclevel.pocket import PocketWorld
-from opennbt import NBTFile
+from pocket_mmap import read_world_size
+
+# pymclevel and opennbt take a while to import, they are
+# only imported by the functions which need them
 
 logger = logging.getLogger(__name__)
 
-def load_world_and_player(w_file):
+def load_world(w_file, use_mmap=False):
+    """Load a world given either its path or the path of chunks.dat.
+    With use_mmap chunks.dat is memory mapped and chunks are only
+    decoded when used instead of loading the whole file."""
+
     # w_file can be either a path or filename
     # either way chunks.dat gets loaded
+    if use_mmap:
+        from pocket_mmap import MappedPocketWorld
+        world = MappedPocketWorld(w_file)
+        logger.info("Mapped world file: %s" % world.filename)
+        return world
+
+    from pymclevel.pocket import PocketWorld
     world = PocketWorld(w_file)
     logger.info("Loaded world file: %s" % world.filename)
 
-    # Fix incorrect bounding box sizes
-    all_chunks = array(world.allChunks)
-    maxx = (max(all_chunks[:,0])+1)*16
-    maxz = (max(all_chunks[:,1])+1)*16
-    world.Width = maxx
-    world.Length = maxz
+    # Fix incorrect bounding box sizes using the chunk index at the
+    # start of chunks.dat instead of going through every chunk
+    world.Width, world.Length = read_world_size(world.filename)
+
+    return world
+
+def load_player(world):
+    """Load the player file, level.dat, from the same path as a world"""
+
+    from opennbt import NBTFile
 
-    # Load level file from same path as world file
     p_file = os.path.join(os.path.dirname(world.filename), "level.dat")
     player = NBTFile(p_file, compressed=False)
     logger.info("Loaded player file: %s" % p_file)
 
+    return player
+
+def load_world_and_player(w_file, use_mmap=False):
+    world = load_world(w_file, use_mmap)
+    player = load_player(world)
+
     return world, player
 
 def get_player_pos_yaw(player):